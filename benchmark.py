@@ -0,0 +1,311 @@
+""" Benchmarks for the CAN explorer.
+
+Synthetic traffic is pushed through the real stack. Run all benchmarks with:
+
+    $ python benchmark.py
+
+Or a selection of them, and store the results for comparison with a later run:
+
+    $ python benchmark.py --json before.json pipeline candump
+
+The Qt parts run on the offscreen platform, so no display is required.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from can_link import CanMessage, DummyCanLink, SocketCanLink
+
+
+def make_messages(count, ids=64, size=8, fd=False):
+    """ Create synthetic traffic with a spread of ids and payloads. """
+    now = datetime.datetime.now()
+    messages = []
+    for i in range(count):
+        can_id = 0x100 + (i % ids)
+        data = bytes((i + j) & 0xFF for j in range(size))
+        timestamp = now - datetime.timedelta(milliseconds=count - i)
+        message = CanMessage(can_id, data, timestamp=timestamp, fd=fd, brs=fd)
+        messages.append(message)
+    return messages
+
+
+# Maximum time in seconds to push all frames through the pipeline:
+PIPELINE_TIMEOUT = 60.0
+
+
+def percentiles(samples, points=(50, 90, 99, 100)):
+    """ Calculate percentiles of the given samples. """
+    samples = sorted(samples)
+    result = {}
+    for point in points:
+        if samples:
+            index = min(len(samples) - 1, int(len(samples) * point / 100))
+            result["p{}".format(point)] = samples[index]
+        else:
+            result["p{}".format(point)] = 0.0
+    return result
+
+
+def get_app():
+    from explorer import QtWidgets
+
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def bench_model_data(frames):
+    """ Measure model data() calls per second, as done by a table repaint. """
+    from explorer import Qt, CanConnection, MessageLogModel
+
+    rows = 50
+    repaints = max(1, frames // (rows * 3 * 2))
+    app = get_app()
+    can_connection = CanConnection(DummyCanLink())
+    model = MessageLogModel(can_connection)
+    model.on_messages(make_messages(rows))
+
+    indexes = [
+        model.index(row, column)
+        for row in range(model.rowCount(None))
+        for column in range(model.columnCount(None))
+    ]
+    roles = [Qt.DisplayRole, Qt.BackgroundRole]
+
+    calls = 0
+    t1 = time.perf_counter()
+    for _ in range(repaints):
+        model._update_color()
+        for index in indexes:
+            for role in roles:
+                model.data(index, role)
+                calls += 1
+    t2 = time.perf_counter()
+    app.processEvents()
+    return {"calls": calls, "seconds": t2 - t1, "calls_per_second": calls / (t2 - t1)}
+
+
+def bench_pipeline(frames):
+    """ Push frames from a receiver thread through the GUI models.
+
+    The path is CanInterface._recv -> CanConnection.messages_received ->
+    MessageLogModel / LastMessageModel / BusLoadWidget.
+    """
+    import explorer
+
+    app = get_app()
+    can_link = DummyCanLink()
+    can_connection = explorer.CanConnection(can_link)
+    consumers = [
+        explorer.MessageLogModel(can_connection),
+        explorer.LastMessageModel(can_connection),
+    ]
+    if not explorer.use_pyqt:
+        consumers.append(explorer.BusLoadWidget(can_connection))
+
+    messages = make_messages(frames)
+    send_times = {}
+    latencies = []
+
+    class LatencyProbe(explorer.QtCore.QObject):
+        """ Lives in the GUI thread, so that delivery is queued. """
+
+        def on_messages(self, messages):
+            now = time.perf_counter()
+            for message in messages:
+                latencies.append(now - send_times[id(message)])
+
+    probe = LatencyProbe()
+    can_connection.messages_received.connect(probe.on_messages)
+
+    producer_errors = []
+
+    def produce():
+        try:
+            for message in messages:
+                send_times[id(message)] = time.perf_counter()
+                can_link._recv(message)
+        except Exception as ex:
+            producer_errors.append(ex)
+            raise
+
+    producer = threading.Thread(target=produce, name="bench-producer")
+    t1 = time.perf_counter()
+    deadline = t1 + PIPELINE_TIMEOUT
+    producer.start()
+    while len(latencies) < frames:
+        producer_done = not producer.is_alive()
+        app.processEvents()
+        if producer_errors:
+            raise RuntimeError("Producer failed: {}".format(producer_errors[0]))
+        if producer_done and len(latencies) < frames:
+            # All frames were produced, and all pending events processed:
+            raise RuntimeError(
+                "Lost {} of {} frames".format(frames - len(latencies), frames)
+            )
+        if time.perf_counter() > deadline:
+            raise RuntimeError("Pipeline did not deliver all frames in time")
+    t2 = time.perf_counter()
+    producer.join()
+
+    result = {
+        "frames": frames,
+        "seconds": t2 - t1,
+        "frames_per_second": frames / (t2 - t1),
+    }
+    for name, value in percentiles(latencies).items():
+        result["latency_{}_us".format(name)] = value * 1e6
+    return result
+
+
+def bench_memory(frames):
+    """ Measure memory per frame retained in the message log. """
+    from explorer import CanConnection, MessageLogModel
+
+    get_app()
+    can_connection = CanConnection(DummyCanLink())
+    model = MessageLogModel(can_connection)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    model.on_messages(make_messages(frames))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"frames": frames, "bytes_per_frame": (after - before) / frames}
+
+
+def bench_candump(frames):
+    """ Measure candump style formatting of messages. """
+    messages = make_messages(frames)
+    t1 = time.perf_counter()
+    for message in messages:
+        str(message)
+    t2 = time.perf_counter()
+    return {"frames": frames, "frames_per_second": frames / (t2 - t1)}
+
+
+def bench_socketcan(frames, size=8, fd=False):
+    """ Measure the socketcan frame packing and unpacking.
+
+    The batch decoding includes the creation of the messages, as done by
+    the receiver thread.
+    """
+    can_link = SocketCanLink("vcan0")
+    messages = make_messages(frames, size=size, fd=fd)
+
+    t1 = time.perf_counter()
+    packed = [can_link.pack(message) for message in messages]
+    t2 = time.perf_counter()
+    for frame in packed:
+        can_link.unpack(frame)
+    t3 = time.perf_counter()
+    timestamp = datetime.datetime.now()
+    batch_size = can_link.recv_batch_size
+    for offset in range(0, frames, batch_size):
+        can_link.unpack_batch(packed[offset : offset + batch_size], timestamp)
+    t4 = time.perf_counter()
+    return {
+        "frames": frames,
+        "pack_frames_per_second": frames / (t2 - t1),
+        "unpack_frames_per_second": frames / (t3 - t2),
+        "decode_batch_frames_per_second": frames / (t4 - t3),
+    }
+
+
+def bench_columnar(frames):
+    """ Measure conversion of candump output into columns, and queries. """
+    import columnar
+
+    lines = [str(message) for message in make_messages(frames)]
+    t1 = time.perf_counter()
+    columns = columnar.concatenate(list(columnar.iter_chunks(lines)))
+    t2 = time.perf_counter()
+    columnar.period_stats(columns)
+    t3 = time.perf_counter()
+    columnar.extract_signal(columnar.filter_frames(columns, ids=[0x100]), 0, 2)
+    t4 = time.perf_counter()
+    return {
+        "frames": frames,
+        "convert_frames_per_second": frames / (t2 - t1),
+        "period_stats_frames_per_second": frames / (t3 - t2),
+        "filter_extract_frames_per_second": frames / (t4 - t3),
+    }
+
+
+def bench_isotp(frames):
+    """ Measure multi-kilobyte ISO-TP transfers, as done when flashing. """
+    import isotp
+
+    can_link = DummyCanLink()
+    layer = isotp.IsoTpLayer(can_link)
+    sender = layer.add_session(0x7E8, 0x7E0)
+    layer.add_session(0x7E0, 0x7E8, max_size=0x10000, block_size=16)
+    received = []
+    layer.attach_pdu_callback(received.append)
+
+    payload = bytes(i & 0xFF for i in range(0x10000))
+    transfers = max(1, frames * 7 // len(payload))
+    t1 = time.perf_counter()
+    for _ in range(transfers):
+        sender.send(payload)
+    t2 = time.perf_counter()
+    assert len(received) == transfers
+    return {
+        "transfers": transfers,
+        "bytes_per_second": transfers * len(payload) / (t2 - t1),
+        "frames_per_second": transfers * len(payload) / 7 / (t2 - t1),
+    }
+
+
+benchmarks = {
+    "model_data": bench_model_data,
+    "pipeline": bench_pipeline,
+    "memory": bench_memory,
+    "candump": bench_candump,
+    "socketcan": bench_socketcan,
+    "socketcan_fd": lambda frames: bench_socketcan(frames, size=64, fd=True),
+    "columnar": bench_columnar,
+    "isotp": bench_isotp,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="benchmarks to run, one of: {}".format(", ".join(benchmarks)),
+    )
+    parser.add_argument("--frames", default=20000, type=int)
+    parser.add_argument("--json", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    names = args.benchmarks or list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            parser.error("Invalid benchmark {}".format(name))
+
+    results = {}
+    for name in names:
+        result = benchmarks[name](args.frames)
+        results[name] = result
+        print(name)
+        for key, value in result.items():
+            if isinstance(value, float):
+                print("    {:30} {:.3f}".format(key, value))
+            else:
+                print("    {:30} {}".format(key, value))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
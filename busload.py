@@ -9,7 +9,7 @@ from PySide2.QtCore import Qt
 class BusLoadWidget(QtWidgets.QWidget):
     def __init__(self, can_connection):
         super().__init__()
-        self._messages = []
+        self._bits = 0
 
         layout = QtWidgets.QVBoxLayout()
         self.chart_view = QtCharts.QChartView()
@@ -43,15 +43,15 @@ class BusLoadWidget(QtWidgets.QWidget):
         self.timer.timeout.connect(self.on_timer)
         self.timer.start(500)
 
-        can_connection.message_received.connect(self.on_message)
+        can_connection.messages_received.connect(self.on_messages)
 
-    def on_message(self, message):
-        self._messages.append(message)
+    def on_messages(self, messages):
+        self._bits += sum(m.bitsize() for m in messages)
 
     def on_timer(self):
         # Okay, bucket all incoming messages.
-        bits = sum(m.bitsize() for m in self._messages)
-        self._messages = []
+        bits = self._bits
+        self._bits = 0
         now = QtCore.QDateTime.currentDateTime()
         timespan = self._prev_time.msecsTo(now) * 0.001
         self._prev_time = now
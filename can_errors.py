@@ -2,8 +2,139 @@
 
 See also: /usr/include/linux/can/error.h
 
+Error frames are decoded using lookup tables, which are computed once at
+import time.
 """
 
+import collections
+import socket
+
+
+# Error classes, in the can id of the error frame:
+CAN_ERR_TX_TIMEOUT = 0x1
+CAN_ERR_LOSTARB = 0x2
+CAN_ERR_CRTL = 0x4
+CAN_ERR_PROT = 0x8
+CAN_ERR_TRX = 0x10
+CAN_ERR_ACK = 0x20
+CAN_ERR_BUSOFF = 0x40
+CAN_ERR_BUSERROR = 0x80
+CAN_ERR_RESTARTED = 0x100
+CAN_ERR_CNT = 0x200
+CAN_ERR_MASK = 0x1FFFFFFF
+
+# Controller problems, in data[1]:
+CAN_ERR_CRTL_RX_OVERFLOW = 0x01
+CAN_ERR_CRTL_TX_OVERFLOW = 0x02
+CAN_ERR_CRTL_RX_WARNING = 0x04
+CAN_ERR_CRTL_TX_WARNING = 0x08
+CAN_ERR_CRTL_RX_PASSIVE = 0x10
+CAN_ERR_CRTL_TX_PASSIVE = 0x20
+CAN_ERR_CRTL_ACTIVE = 0x40
+
+# Protocol error types, in data[2]:
+CAN_ERR_PROT_BIT = 0x01
+CAN_ERR_PROT_FORM = 0x02
+CAN_ERR_PROT_STUFF = 0x04
+CAN_ERR_PROT_BIT0 = 0x08
+CAN_ERR_PROT_BIT1 = 0x10
+CAN_ERR_PROT_OVERLOAD = 0x20
+CAN_ERR_PROT_ACTIVE = 0x40
+CAN_ERR_PROT_TX = 0x80
+
+
+def _bit_table(names):
+    """ Create a table which maps each byte value to the names of its bits. """
+    return [
+        tuple(name for bit, name in names if value & bit) for value in range(256)
+    ]
+
+
+ERROR_CLASS_NAMES = [
+    (CAN_ERR_TX_TIMEOUT, "tx-timeout"),
+    (CAN_ERR_LOSTARB, "lost-arbitration"),
+    (CAN_ERR_CRTL, "controller"),
+    (CAN_ERR_PROT, "protocol"),
+    (CAN_ERR_TRX, "transceiver"),
+    (CAN_ERR_ACK, "no-ack"),
+    (CAN_ERR_BUSOFF, "bus-off"),
+    (CAN_ERR_BUSERROR, "bus-error"),
+    (CAN_ERR_RESTARTED, "restarted"),
+]
+
+# Error class bits to class names:
+ERROR_CLASS_TABLE = [
+    tuple(name for bit, name in ERROR_CLASS_NAMES if value & bit)
+    for value in range(CAN_ERR_CNT)
+]
+
+CONTROLLER_TABLE = _bit_table(
+    [
+        (CAN_ERR_CRTL_RX_OVERFLOW, "rx-overflow"),
+        (CAN_ERR_CRTL_TX_OVERFLOW, "tx-overflow"),
+        (CAN_ERR_CRTL_RX_WARNING, "rx-warning"),
+        (CAN_ERR_CRTL_TX_WARNING, "tx-warning"),
+        (CAN_ERR_CRTL_RX_PASSIVE, "rx-error-passive"),
+        (CAN_ERR_CRTL_TX_PASSIVE, "tx-error-passive"),
+        (CAN_ERR_CRTL_ACTIVE, "error-active"),
+    ]
+)
+
+PROTOCOL_TABLE = _bit_table(
+    [
+        (CAN_ERR_PROT_BIT, "bit"),
+        (CAN_ERR_PROT_FORM, "form"),
+        (CAN_ERR_PROT_STUFF, "stuff"),
+        (CAN_ERR_PROT_BIT0, "bit0"),
+        (CAN_ERR_PROT_BIT1, "bit1"),
+        (CAN_ERR_PROT_OVERLOAD, "overload"),
+        (CAN_ERR_PROT_ACTIVE, "active-error"),
+        (CAN_ERR_PROT_TX, "tx"),
+    ]
+)
+
+# Protocol error location, in data[3]:
+_locations = {
+    0x00: "unspecified",
+    0x03: "start-of-frame",
+    0x02: "id28-21",
+    0x06: "id20-18",
+    0x04: "srtr",
+    0x05: "ide",
+    0x07: "id17-13",
+    0x0F: "id12-05",
+    0x0E: "id04-00",
+    0x0C: "rtr",
+    0x0D: "reserved-bit-1",
+    0x09: "reserved-bit-0",
+    0x0B: "dlc",
+    0x0A: "data",
+    0x08: "crc-sequence",
+    0x18: "crc-delimiter",
+    0x19: "ack-slot",
+    0x1B: "ack-delimiter",
+    0x1A: "end-of-frame",
+    0x12: "intermission",
+}
+LOCATION_TABLE = [_locations.get(value, "unknown") for value in range(256)]
+
+# Transceiver status, in data[4]:
+_transceiver_states = {
+    0x00: "unspecified",
+    0x04: "canh-no-wire",
+    0x05: "canh-short-to-bat",
+    0x06: "canh-short-to-vcc",
+    0x07: "canh-short-to-gnd",
+    0x40: "canl-no-wire",
+    0x50: "canl-short-to-bat",
+    0x60: "canl-short-to-vcc",
+    0x70: "canl-short-to-gnd",
+    0x80: "canl-short-to-canh",
+}
+TRANSCEIVER_TABLE = [
+    _transceiver_states.get(value, "unknown") for value in range(256)
+]
+
 
 def message_to_errors(message):
     """ Given a CAN message, create the proper errors from it.
@@ -11,6 +142,24 @@ def message_to_errors(message):
     if message.id & socket.CAN_ERR_FLAG == 0:
         raise ValueError("Not an error CAN message")
 
+    data = bytes(message.data).ljust(8, b"\x00")
+    errors = []
+
+    if message.id & CAN_ERR_TX_TIMEOUT:
+        errors.append(TxTimeoutError())
+
+    if message.id & CAN_ERR_LOSTARB:
+        errors.append(LostArbitrationError(data[0]))
+
+    if message.id & CAN_ERR_CRTL:
+        errors.append(ControllerError(CONTROLLER_TABLE[data[1]]))
+
+    if message.id & CAN_ERR_PROT:
+        errors.append(ProtocolError(PROTOCOL_TABLE[data[2]], LOCATION_TABLE[data[3]]))
+
+    if message.id & CAN_ERR_TRX:
+        errors.append(TransceiverError(TRANSCEIVER_TABLE[data[4]]))
+
     if message.id & CAN_ERR_ACK:
         errors.append(AckError())
 
@@ -20,14 +169,62 @@ def message_to_errors(message):
     if message.id & CAN_ERR_BUSERROR:
         errors.append(BusError())
 
+    if message.id & CAN_ERR_RESTARTED:
+        errors.append(RestartedError())
+
+    if message.id & CAN_ERR_CNT:
+        for error in errors:
+            error.tx_errors = data[6]
+            error.rx_errors = data[7]
+
     return errors
 
 
 # Exception hierarchy:
 class CanException(Exception):
+    tx_errors = None
+    rx_errors = None
+
+
+class TxTimeoutError(CanException):
     pass
 
 
+class LostArbitrationError(CanException):
+    def __init__(self, bit):
+        super().__init__("lost arbitration at bit {}".format(bit))
+        self.bit = bit
+
+
+class ControllerError(CanException):
+    def __init__(self, problems):
+        super().__init__(", ".join(problems))
+        self.problems = problems
+
+    @property
+    def error_passive(self):
+        return (
+            "rx-error-passive" in self.problems or "tx-error-passive" in self.problems
+        )
+
+    @property
+    def error_active(self):
+        return "error-active" in self.problems
+
+
+class ProtocolError(CanException):
+    def __init__(self, types, location):
+        super().__init__("{} at {}".format(", ".join(types), location))
+        self.types = types
+        self.location = location
+
+
+class TransceiverError(CanException):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
 class AckError(CanException):
     pass
 
@@ -40,11 +237,43 @@ class BusError(CanException):
     pass
 
 
-CAN_ERR_TX_TIMEOUT = 0x1
-CAN_ERR_LOSTARB = 0x2
-CAN_ERR_CTRL = 0x4
-CAN_ERR_PROT = 0x8
-CAN_ERR_TRX = 0x10
-CAN_ERR_ACK = 0x20
-CAN_ERR_BUSOFF = 0x40
-CAN_ERR_BUSERROR = 0x80
+class RestartedError(CanException):
+    pass
+
+
+class ErrorChannel:
+    """ Bounded channel for error frames, separate from normal frames.
+
+    The receiver thread only counts the error classes and queues the raw
+    message. Decoding is done by the consumer. When the channel is full,
+    the oldest error frames are dropped, so that an error storm can never
+    stall the receiver thread.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.counts = collections.Counter()
+        self.dropped = 0
+        self._messages = collections.deque(maxlen=maxsize)
+        self._subscribers = []
+
+    def attach_callback(self, callback):
+        """ Register a callback, called on the receiver thread per error frame. """
+        self._subscribers.append(callback)
+
+    def put(self, message):
+        for name in ERROR_CLASS_TABLE[message.id & (CAN_ERR_CNT - 1)]:
+            self.counts[name] += 1
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped += 1
+        self._messages.append(message)
+
+        for callback in self._subscribers:
+            callback(message)
+
+    def get_all(self):
+        """ Take all pending error frames, as (message, errors) tuples. """
+        result = []
+        while self._messages:
+            message = self._messages.popleft()
+            result.append((message, message_to_errors(message)))
+        return result
@@ -3,15 +3,46 @@
 
 import struct
 import datetime
+import errno
+import heapq
+import itertools
+import select
 import socket
 import threading
 import logging
 import queue
+import time
 
 import can_errors
+from metrics import registry
 
 logger = logging.getLogger("can-explorer")
 
+recv_frames = registry.counter("can_recv_frames_total", "Received frames")
+recv_callback_time = registry.histogram(
+    "can_recv_callback_seconds", "Time spent in receive callbacks per frame"
+)
+recv_queue_depth = registry.gauge("can_recv_queue_depth", "Receive queue depth")
+recv_queue_drops = registry.counter(
+    "can_recv_queue_drops_total", "Frames dropped because the receive queue was full"
+)
+kernel_drops = registry.gauge(
+    "can_kernel_drops", "Frames dropped by the kernel socket buffer"
+)
+send_frames = registry.counter("can_send_frames_total", "Sent frames")
+send_latency = registry.histogram(
+    "can_send_latency_seconds", "Time from queueing a frame until it was sent"
+)
+send_backlog = registry.gauge("can_send_backlog", "Frames waiting to be sent")
+send_retries = registry.counter(
+    "can_send_retries_total", "Send retries because the TX queue was full"
+)
+error_frames = registry.counter("can_error_frames_total", "Received error frames")
+send_drops = registry.counter(
+    "can_send_drops_total",
+    "Frames dropped because the send queue was full, or sending failed",
+)
+
 
 def make_can_link(spec):
     """ Create a can link given a specifier.
@@ -40,17 +71,61 @@ class CanInterface:
 
     def __init__(self):
         self._recv_subscribers = []
-        self._recv_queue = queue.Queue(maxsize=100)
+        self._sent_subscribers = []
+        self._recv_queue = None
+        self.errors = can_errors.ErrorChannel()
 
     def attach_recv_callback(self, callback):
         self._recv_subscribers.append(callback)
 
-    def _recv(self, message):
-        if not self._recv_queue.full():
-            self._recv_queue.put(message)
+    def attach_sent_callback(self, callback):
+        """ Register a callback called with (message, latency) once sent. """
+        self._sent_subscribers.append(callback)
 
-        for callback in self._recv_subscribers:
-            callback(message)
+    def _sent(self, message, latency):
+        for callback in self._sent_subscribers:
+            callback(message, latency)
+
+    @property
+    def send_backlog(self):
+        """ The number of messages waiting to be sent. """
+        return 0
+
+    def open_recv_queue(self, maxsize=100):
+        """ Queue received messages for recv().
+
+        Only users of recv() need the queue, so it is not created until
+        requested. Open it before connecting to not miss any messages.
+        """
+        if self._recv_queue is None:
+            self._recv_queue = queue.Queue(maxsize=maxsize)
+
+    def _recv(self, message):
+        self._recv_batch((message,))
+
+    def _recv_batch(self, messages):
+        """ Deliver a batch of received messages to the subscribers. """
+        enabled = registry.enabled
+        if enabled:
+            recv_frames.inc(len(messages))
+
+        recv_queue = self._recv_queue
+        if recv_queue is not None:
+            for message in messages:
+                if not recv_queue.full():
+                    recv_queue.put(message)
+                elif enabled:
+                    recv_queue_drops.inc()
+            if enabled:
+                recv_queue_depth.set(recv_queue.qsize())
+
+        if enabled:
+            t1 = time.perf_counter()
+        for message in messages:
+            for callback in self._recv_subscribers:
+                callback(message)
+        if enabled:
+            recv_callback_time.observe((time.perf_counter() - t1) / len(messages))
 
     def connect(self):
         raise NotImplementedError()
@@ -58,11 +133,17 @@ class CanInterface:
     def disconnect(self):
         raise NotImplementedError()
 
-    def send(self, message):
+    def send(self, message, block=False, timeout=None):
+        """ Queue a message for sending.
+
+        When the send queue is full, block for room if requested. Returns
+        whether the message was queued, False when it was dropped.
+        """
         raise NotImplementedError()
 
     def recv(self):
         """ Blocks until a message is received. """
+        self.open_recv_queue()
         return self._recv_queue.get()
 
 
@@ -75,84 +156,435 @@ class DummyCanLink(CanInterface):
     def disconnect(self):
         pass
 
-    def send(self, message):
+    def send(self, message, block=False, timeout=None):
         timestamp = datetime.datetime.now()
-        new_message = CanMessage(message.id, message.data, timestamp=timestamp)
+        new_message = CanMessage(
+            message.id,
+            message.data,
+            timestamp=timestamp,
+            fd=message.fd,
+            brs=message.brs,
+            extended=message.extended,
+        )
+        self._sent(message, 0.0)
         self._recv(new_message)
+        return True
 
 
 # See also: /usr/include/linux/can/error.h
 
+# See also: /usr/include/asm-generic/socket.h
+SO_RXQ_OVFL = 40
+
+# See also: /usr/include/linux/can.h
+CAN_RAW_ERR_FILTER = 2
+CAN_MTU = 16
+CANFD_MTU = 72
+CANFD_BRS = 0x01
+CANFD_ESI = 0x02
+CANFD_LENGTHS = [0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64]
+
+
+def fd_length(size):
+    """ Round a payload size up to the next valid CAN FD length. """
+    for length in CANFD_LENGTHS:
+        if length >= size:
+            return length
+    raise ValueError("CAN FD payload can be at most 64 bytes")
+
 
 class SocketCanLink(CanInterface):
     """ Socket can interface.
 
+    Messages are sent by a sender thread, so that send never blocks the
+    caller. Pending messages are sent lowest can id first, mirroring the
+    bus arbitration.
+
     Links:
     http://www.bencz.com/hacks/2016/07/10/python-and-socketcan/
     """
 
     fmt = "<IB3x8s"
+    fd_fmt = "<IBB2x64s"
+    send_queue_size = 1000
+    recv_batch_size = 64
+    send_batch_size = 32
+    min_backoff = 0.001
+    max_backoff = 0.1
+    # Minimum time in seconds between two log messages about dropped frames:
+    drop_log_interval = 5.0
 
     def __init__(self, interface):
         super().__init__()
         self.interface = interface
+        self.mtu = CAN_MTU
+        self._struct = struct.Struct(self.fmt)
+        self._fd_struct = struct.Struct(self.fd_fmt)
+        self._send_condition = threading.Condition()
+        # (arbitration key, sequence, queued time, message, packed frame):
+        self._send_heap = []
+        self._send_counter = itertools.count()
+        self._send_in_flight = 0
+        self._send_drops = 0  # Dropped since the last log message
+        self._send_drop_log_time = None
 
     def connect(self):
         self.sock = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
         logger.info("Opening device %s", self.interface)
         self.sock.bind((self.interface,))
-        # Spin receiver thread:
+
+        # Receive error frames of all classes:
+        self.sock.setsockopt(
+            socket.SOL_CAN_RAW,
+            CAN_RAW_ERR_FILTER,
+            struct.pack("=I", can_errors.CAN_ERR_MASK),
+        )
+
+        # Receive CAN FD frames as well, if the kernel supports them:
+        try:
+            self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FD_FRAMES, 1)
+        except OSError as ex:
+            logger.warning("CAN FD not supported: %s", ex)
+            self.mtu = CAN_MTU
+        else:
+            self.mtu = CANFD_MTU
+
+        # Let the kernel report its drop counter, when metrics are wanted:
+        self._rx_overflow = registry.enabled
+        if self._rx_overflow:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+
+        # Spin receiver and sender threads:
         self._running = True
         self.recv_thread = threading.Thread(
             target=self.recv_process, name="socketcan-recv"
         )
         self.recv_thread.start()
+        self.send_thread = threading.Thread(
+            target=self.send_process, name="socketcan-send"
+        )
+        self.send_thread.start()
 
     def disconnect(self):
         logger.info("Closing can device")
+        self.flush(timeout=1.0)
+        with self._send_condition:
+            self._running = False
+            self._send_condition.notify_all()
+        self.send_thread.join()
         self.sock.close()
-        self._running = False
         self.recv_thread.join()
 
-    def send(self, message):
-        data = struct.pack(self.fmt, message.id, len(message.data), message.data)
-        self.sock.send(data)
+    def send(self, message, block=False, timeout=None):
+        """ Queue a message for sending.
+
+        By default this does not block, and the message is dropped when
+        the send queue is full. With block set, wait up to timeout seconds
+        for room in the queue instead. Returns whether the message was
+        queued.
+
+        Raises ValueError for a message which does not fit in a frame.
+        """
+        # Pack on the caller's thread, so that invalid messages are
+        # reported to the caller, instead of ending the sender thread:
+        frame = self.pack(message)
+        with self._send_condition:
+            if block:
+                self._send_condition.wait_for(
+                    lambda: len(self._send_heap) < self.send_queue_size,
+                    timeout=timeout,
+                )
+            if len(self._send_heap) >= self.send_queue_size:
+                self._drop(message)
+                return False
+            item = (
+                message.arbitration_key,
+                next(self._send_counter),
+                time.monotonic(),
+                message,
+                frame,
+            )
+            heapq.heappush(self._send_heap, item)
+            if registry.enabled:
+                send_backlog.set(len(self._send_heap))
+            self._send_condition.notify_all()
+        return True
+
+    def _drop(self, message):
+        """ Count a dropped message, and log a summary of the drops.
+
+        Logging every drop would flood the log exactly when the bus is
+        already overloaded, so at most one error is logged per interval.
+        """
+        if registry.enabled:
+            send_drops.inc()
+        self._send_drops += 1
+        now = time.monotonic()
+        if (
+            self._send_drop_log_time is None
+            or now - self._send_drop_log_time >= self.drop_log_interval
+        ):
+            logger.error(
+                "Send queue full, dropped %s message(s), last %s",
+                self._send_drops,
+                message,
+            )
+            self._send_drops = 0
+            self._send_drop_log_time = now
+
+    @property
+    def send_backlog(self):
+        return len(self._send_heap) + self._send_in_flight
+
+    def flush(self, timeout=None):
+        """ Wait until all queued messages are sent. """
+        with self._send_condition:
+            return self._send_condition.wait_for(
+                lambda: self.send_backlog == 0, timeout=timeout
+            )
+
+    def pack(self, message):
+        """ Pack a message into a can_frame or canfd_frame struct. """
+        can_id = message.id
+        if message.extended:
+            can_id |= socket.CAN_EFF_FLAG
+        if message.fd:
+            if len(message.data) > 64:
+                raise ValueError("CAN FD payload can be at most 64 bytes")
+            size = fd_length(len(message.data))
+            flags = CANFD_BRS if message.brs else 0
+            return self._fd_struct.pack(can_id, size, flags, message.data)
+        else:
+            if len(message.data) > 8:
+                raise ValueError("CAN payload can be at most 8 bytes")
+            return self._struct.pack(can_id, len(message.data), message.data)
+
+    def unpack(self, frame):
+        """ Unpack a can_frame or canfd_frame struct.
+
+        Returns a tuple with can id, data, fd and brs flags.
+        """
+        if len(frame) == CAN_MTU:
+            can_id, size, data = self._struct.unpack(frame)
+            return can_id, data[:size], False, False
+        elif len(frame) == CANFD_MTU:
+            can_id, size, flags, data = self._fd_struct.unpack(frame)
+            return can_id, data[:size], True, bool(flags & CANFD_BRS)
+        else:
+            raise ValueError("Invalid frame size {}".format(len(frame)))
+
+    def unpack_batch(self, frames, timestamp):
+        """ Decode a batch of frames into messages.
+
+        Returns a list of messages and a list of error messages.
+        """
+        unpack = self._struct.unpack
+        unpack_fd = self._fd_struct.unpack
+        messages = []
+        errors = []
+        for frame in frames:
+            if len(frame) == CAN_MTU:
+                can_id, size, data = unpack(frame)
+                fd = brs = False
+            elif len(frame) == CANFD_MTU:
+                can_id, size, flags, data = unpack_fd(frame)
+                fd = True
+                brs = bool(flags & CANFD_BRS)
+            else:
+                raise ValueError("Invalid frame size {}".format(len(frame)))
+
+            if can_id & socket.CAN_ERR_FLAG:
+                errors.append(CanMessage(can_id, data[:size], timestamp=timestamp))
+            else:
+                message = CanMessage(
+                    can_id & socket.CAN_EFF_MASK,
+                    data[:size],
+                    timestamp=timestamp,
+                    fd=fd,
+                    brs=brs,
+                    extended=bool(can_id & socket.CAN_EFF_FLAG),
+                )
+                messages.append(message)
+        return messages, errors
+
+    def recv_frames(self):
+        """ Block for a frame, then take up to a batch of pending frames. """
+        if self._rx_overflow:
+            frames = [self.recv_with_overflow()]
+        else:
+            frames = [self.sock.recv(self.mtu)]
+        while len(frames) < self.recv_batch_size:
+            try:
+                frames.append(self.sock.recv(self.mtu, socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                break
+        return frames
 
     def recv_process(self):
         logger.info("Receiver thread started")
         while self._running:
             # Block:
-            data = self.sock.recv(16)
-            assert len(data) == 16
-            can_id, size, data = struct.unpack(self.fmt, data)
-            data = data[:size]
+            frames = self.recv_frames()
             timestamp = datetime.datetime.now()
+            messages, errors = self.unpack_batch(frames, timestamp)
 
-            # Maybe we received an error frame:
-            if can_id & socket.CAN_ERR_FLAG:
-                message = CanMessage(can_id, data, timestamp=timestamp)
-                errors = message_to_errors(message)
-                print(errors)
-            else:
-                can_id &= socket.CAN_EFF_MASK
-                message = CanMessage(can_id, data, timestamp=timestamp)
-                self._recv(message)
+            # Maybe we received error frames:
+            if errors:
+                if registry.enabled:
+                    error_frames.inc(len(errors))
+                for message in errors:
+                    self.errors.put(message)
+
+            if messages:
+                self._recv_batch(messages)
 
         logger.info("Receiver thread finished")
 
+    def send_process(self):
+        logger.info("Sender thread started")
+        poller = select.poll()
+        poller.register(self.sock, select.POLLOUT)
+        backoff = self.min_backoff
+        while True:
+            with self._send_condition:
+                self._send_condition.wait_for(
+                    lambda: self._send_heap or not self._running
+                )
+                if not self._running:
+                    break
+                batch = [
+                    heapq.heappop(self._send_heap)
+                    for _ in range(min(self.send_batch_size, len(self._send_heap)))
+                ]
+                self._send_in_flight = len(batch)
+                # Wake up senders waiting for room in the queue:
+                self._send_condition.notify_all()
+
+            # Wait until the socket is writable:
+            poller.poll(100)
+
+            try:
+                backoff = self._send_batch(batch, backoff)
+            finally:
+                with self._send_condition:
+                    self._send_in_flight = 0
+                    if registry.enabled:
+                        send_backlog.set(len(self._send_heap))
+                    self._send_condition.notify_all()
+
+        logger.info("Sender thread finished")
+
+    def _send_batch(self, batch, backoff):
+        """ Send a batch of queued items, and give the next backoff time.
+
+        A message which fails to send is logged and dropped, so that it
+        cannot end the sender thread.
+        """
+        enabled = registry.enabled
+        for index, item in enumerate(batch):
+            message = item[3]
+            try:
+                self.sock.send(item[4], socket.MSG_DONTWAIT)
+            except OSError as ex:
+                if ex.errno in (errno.ENOBUFS, errno.EAGAIN):
+                    # TX queue full, put back the remaining messages:
+                    if enabled:
+                        send_retries.inc()
+                    with self._send_condition:
+                        for remaining in batch[index:]:
+                            heapq.heappush(self._send_heap, remaining)
+                        self._send_in_flight -= len(batch) - index
+                    time.sleep(backoff)
+                    return min(backoff * 2, self.max_backoff)
+                self._send_failed(message, ex)
+                continue
+            except Exception as ex:
+                self._send_failed(message, ex)
+                continue
+
+            backoff = self.min_backoff
+            latency = time.monotonic() - item[2]
+            if enabled:
+                send_frames.inc()
+                send_latency.observe(latency)
+            try:
+                self._sent(message, latency)
+            except Exception:
+                logger.exception("Error in sent callback for %s", message)
+        return backoff
+
+    def _send_failed(self, message, ex):
+        logger.error("Error sending %s: %s", message, ex)
+        if registry.enabled:
+            send_drops.inc()
+
+    def recv_with_overflow(self):
+        """ Receive a frame, and update the kernel drop counter. """
+        frame, ancdata, _, _ = self.sock.recvmsg(self.mtu, socket.CMSG_SPACE(4))
+        for level, kind, value in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                kernel_drops.set(struct.unpack("=I", value[:4])[0])
+        return frame
+
 
 class CanMessage:
-    """ Represents a single can message. """
+    """ Represents a single can message.
+
+    CAN FD messages have the fd flag set. The brs flag indicates bit rate
+    switching, so the data phase is sent at the higher data bit rate.
+
+    The extended flag selects the 29 bit frame format. When not given,
+    ids above 0x7FF are extended.
+    """
+
+    # Ratio of the data bit rate to the nominal bit rate, for example
+    # 2 Mbit/s data phase over a 500 kbit/s arbitration phase:
+    data_rate_factor = 4
 
-    def __init__(self, id, data, timestamp=None):
+    def __init__(self, id, data, timestamp=None, fd=False, brs=False, extended=None):
         self.id = id
         self.data = data
         self.timestamp = timestamp
+        self.fd = fd
+        self.brs = brs
+        if extended is None:
+            extended = id > 0x7FF
+        self.extended = extended
+
+    @property
+    def arbitration_key(self):
+        """ Sort key for bus priority, lower keys win arbitration.
+
+        On the bus the 11 bit base id is compared first, and a standard
+        frame wins from an extended frame with the same base id, since
+        its IDE bit is dominant. Only then the 18 bit id extension is
+        compared.
+        """
+        if self.extended:
+            return (self.id >> 18) << 19 | 1 << 18 | (self.id & 0x3FFFF)
+        else:
+            return self.id << 19
 
     def bitsize(self):
-        """ Give some metrics for this message size. """
-        # TODO: this should be bit correct!
-        return len(self.data) * 8 + 11
+        """ Give the duration of this message in nominal bit times.
+
+        Bit stuffing is not taken into account.
+        """
+        if self.fd:
+            size = fd_length(len(self.data))
+            # SOF, ID, RRS, IDE, FDF, res, BRS:
+            arbitration_bits = 36 if self.extended else 17
+            # ESI, DLC, data, stuff count, CRC, CRC delimiter:
+            crc_bits = 17 if size <= 16 else 21
+            data_bits = 1 + 4 + size * 8 + 4 + crc_bits + 1
+            if self.brs:
+                data_bits /= self.data_rate_factor
+            # ACK, EOF, IFS:
+            return arbitration_bits + data_bits + 12
+        else:
+            # SOF, ID, RTR, IDE, r0, DLC, CRC, ACK, EOF, IFS:
+            overhead = 67 if self.extended else 47
+            return len(self.data) * 8 + overhead
 
     @property
     def fancytimestamp(self):
@@ -162,6 +594,14 @@ class CanMessage:
             # return self.timestamp.strftime('%A %d %B %Y %H:%M:%S.%f')
             return self.timestamp.strftime("%H:%M:%S.%f")
 
+    @property
+    def fulltimestamp(self):
+        """ Date and time, so that logs spanning midnight stay ordered. """
+        if self.timestamp is None:
+            return ""
+        else:
+            return self.timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
+
     @property
     def age(self):
         if self.timestamp is None:
@@ -179,6 +619,15 @@ class CanMessage:
         return " ".join(b)
 
     def __str__(self):
-        return "CAN msg ID={:X} LEN={} DATA={} {}".format(
-            self.id, len(self.data), self.hexdata, self.fancytimestamp
+        if self.fd:
+            kind = "CAN FD BRS msg" if self.brs else "CAN FD msg"
+        else:
+            kind = "CAN msg"
+        can_id = "{:08X}" if self.extended else "{:X}"
+        return "{} ID={} LEN={} DATA={} {}".format(
+            kind,
+            can_id.format(self.id),
+            len(self.data),
+            self.hexdata,
+            self.fulltimestamp,
         )
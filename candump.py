@@ -1,20 +1,38 @@
 """ Simple can dump utility. """
 
 import argparse
+import logging
 from can_link import make_can_link
+import capture
+import metrics
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("interface")
+    parser.add_argument(
+        "--quiet", "-q", action="store_true", help="do not print received frames"
+    )
+    metrics.add_arguments(parser)
+    capture.add_arguments(parser)
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    metrics.setup_from_args(args)
     can_link = make_can_link(args.interface)
+    trigger_capture = capture.setup_from_args(args, can_link)
+    can_link.open_recv_queue()
     can_link.connect()
 
-    while True:
-        message = can_link.recv()
-        print(message)
+    try:
+        while True:
+            message = can_link.recv()
+            if not args.quiet:
+                print(message)
+    except KeyboardInterrupt:
+        pass
 
+    if trigger_capture:
+        trigger_capture.close()
     can_link.disconnect()
 
 
@@ -8,17 +8,30 @@ from can_link import make_can_link, CanMessage
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("interface")
-    parser.add_argument("can_id")
+    parser.add_argument(
+        "can_id", help="can id in hex, with 8 digits for an extended id"
+    )
     parser.add_argument("data", help="data as hex text")
+    parser.add_argument("--fd", action="store_true", help="send a CAN FD frame")
+    parser.add_argument(
+        "--brs", action="store_true", help="use bit rate switching (implies --fd)"
+    )
     args = parser.parse_args()
 
-    can_link = make_can_link(args.interface)
-    can_link.connect()
-
     can_id = int(args.can_id, 16)
     data = bytes.fromhex(args.data)
 
-    message = CanMessage(can_id, data)
+    fd = args.fd or args.brs
+    max_size = 64 if fd else 8
+    if len(data) > max_size:
+        parser.error("At most {} data bytes can be sent".format(max_size))
+
+    can_link = make_can_link(args.interface)
+    can_link.connect()
+
+    # Like can-utils, more than 3 digits select the extended frame format:
+    extended = len(args.can_id) > 3
+    message = CanMessage(can_id, data, fd=fd, brs=args.brs, extended=extended)
     can_link.send(message)
 
     can_link.disconnect()
@@ -0,0 +1,301 @@
+""" Triggered capture of CAN traffic.
+
+The last frames are kept in a preallocated ring buffer. When a trigger
+fires, the pre-trigger window and a post-trigger window are written to
+disk, after which the capture re-arms.
+
+Triggers are evaluated for every frame on the receiver thread, so they
+are kept cheap: id and payload triggers are precompiled into a dict
+keyed by can id. Writing files is done by a separate writer thread.
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+
+from metrics import registry
+
+logger = logging.getLogger("can-explorer")
+
+capture_triggers = registry.counter("capture_triggers_total", "Capture triggers")
+capture_files = registry.counter("capture_files_total", "Written capture files")
+
+
+class RingBuffer:
+    """ Fixed size buffer keeping the last frames. """
+
+    def __init__(self, capacity):
+        self._items = [None] * capacity
+        self._index = 0
+        self._count = 0
+
+    def append(self, item):
+        self._items[self._index] = item
+        self._index = (self._index + 1) % len(self._items)
+        if self._count < len(self._items):
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def snapshot(self):
+        """ Get the contents, oldest item first. """
+        if self._count < len(self._items):
+            return self._items[: self._count]
+        else:
+            return self._items[self._index :] + self._items[: self._index]
+
+
+class PayloadMatcher:
+    """ Matches a payload against a value under a mask. """
+
+    def __init__(self, value, mask=None):
+        if mask is None:
+            mask = b"\xff" * len(value)
+        if len(mask) != len(value):
+            raise ValueError("Mask and value must have the same length")
+        self.size = len(value)
+        self.mask = int.from_bytes(mask, "big")
+        self.value = int.from_bytes(value, "big") & self.mask
+
+    def __call__(self, data):
+        if len(data) < self.size:
+            return False
+        return int.from_bytes(data[: self.size], "big") & self.mask == self.value
+
+
+class TriggerCapture:
+    """ Capture a window of frames around trigger conditions.
+
+    Possible triggers:
+    - a can id, optionally with a payload matcher
+    - an error frame
+    - a frame rate above a maximum (rate anomaly)
+
+    The post-trigger window ends after post_frames frames, or after
+    post_seconds, even when no more frames arrive.
+    """
+
+    # Interval in seconds to check for an expired post-trigger window:
+    expire_interval = 0.1
+
+    def __init__(
+        self,
+        directory=".",
+        pre_frames=10000,
+        pre_seconds=None,
+        post_frames=1000,
+        post_seconds=1.0,
+    ):
+        if pre_frames < 1:
+            raise ValueError("At least the trigger frame must be captured")
+        self.directory = directory
+        self.pre_seconds = pre_seconds
+        self.post_frames = post_frames
+        self.post_seconds = post_seconds
+        self.trigger_on_error = False
+        self.max_rate = None
+        self._id_triggers = {}  # can id -> list of payload matchers, or None
+        self._ring = RingBuffer(pre_frames)
+        self._lock = threading.Lock()
+        # (trigger reason, trigger message, frames, trigger index, deadline):
+        self._capture = None
+        self._rate_second = None
+        self._rate_count = 0
+        self._write_queue = queue.Queue()
+        self._writer_thread = threading.Thread(
+            target=self._write_process, name="capture-writer"
+        )
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def add_id_trigger(self, can_id, matcher=None):
+        """ Trigger on a can id, and optionally a payload matcher. """
+        if matcher is None:
+            self._id_triggers[can_id] = None
+        elif self._id_triggers.get(can_id, []) is not None:
+            self._id_triggers.setdefault(can_id, []).append(matcher)
+
+    def attach(self, can_link):
+        """ Evaluate the triggers on all frames of the given link. """
+        can_link.attach_recv_callback(self.on_message)
+        can_link.errors.attach_callback(self.on_error)
+
+    def on_message(self, message):
+        with self._lock:
+            self._ring.append(message)
+            if self._capture:
+                self._continue_capture(message)
+                return
+
+            if message.id in self._id_triggers:
+                matchers = self._id_triggers[message.id]
+                if matchers is None:
+                    self._trigger("id {:X}".format(message.id), message)
+                    return
+                for matcher in matchers:
+                    if matcher(message.data):
+                        self._trigger("payload of {:X}".format(message.id), message)
+                        return
+
+            if self.max_rate is not None and message.timestamp is not None:
+                second = message.timestamp.replace(microsecond=0)
+                if second != self._rate_second:
+                    self._rate_second = second
+                    self._rate_count = 0
+                self._rate_count += 1
+                if self._rate_count > self.max_rate:
+                    self._rate_count = 0
+                    self._trigger("rate above {}/s".format(self.max_rate), message)
+
+    def on_error(self, message):
+        with self._lock:
+            self._ring.append(message)
+            if self._capture:
+                self._continue_capture(message)
+            elif self.trigger_on_error:
+                self._trigger("error frame", message)
+
+    def _trigger(self, reason, message):
+        logger.info("Capture triggered by %s", reason)
+        capture_triggers.inc()
+        frames = self._ring.snapshot()
+        if self.pre_seconds is not None and message.timestamp is not None:
+            start = message.timestamp - datetime.timedelta(seconds=self.pre_seconds)
+            frames = [
+                m for m in frames if m.timestamp is None or m.timestamp >= start
+            ]
+        if self.post_seconds is None:
+            deadline = None
+        else:
+            deadline = time.monotonic() + self.post_seconds
+        self._capture = (reason, message, frames, len(frames), deadline)
+
+    def _continue_capture(self, message):
+        reason, trigger_message, frames, trigger_index, deadline = self._capture
+        frames.append(message)
+        post_count = len(frames) - trigger_index
+        if post_count >= self.post_frames:
+            self._finish_capture()
+        elif deadline is not None and time.monotonic() >= deadline:
+            self._finish_capture()
+
+    def _expire_capture(self):
+        """ Finish the capture when its post-trigger window has passed. """
+        with self._lock:
+            if self._capture:
+                deadline = self._capture[4]
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._finish_capture()
+
+    def _finish_capture(self):
+        self._write_queue.put(self._capture[:3])
+        self._capture = None
+
+    def close(self):
+        """ Write a pending capture, and stop the writer thread. """
+        with self._lock:
+            if self._capture:
+                self._finish_capture()
+        self._write_queue.put(None)
+        self._writer_thread.join()
+
+    def _write_process(self):
+        number = 0
+        while True:
+            try:
+                item = self._write_queue.get(timeout=self.expire_interval)
+            except queue.Empty:
+                self._expire_capture()
+                continue
+            if item is None:
+                break
+            reason, trigger_message, frames = item
+            number += 1
+            filename = os.path.join(
+                self.directory,
+                "capture-{}-{}.log".format(
+                    datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), number
+                ),
+            )
+            with open(filename, "w") as f:
+                print("# Triggered by {}: {}".format(reason, trigger_message), file=f)
+                for message in frames:
+                    print(message, file=f)
+            capture_files.inc()
+            logger.info("Capture of %s frames written to %s", len(frames), filename)
+
+
+def parse_trigger(text):
+    """ Parse a trigger in the form ID[:DATA[/MASK]], all in hex. """
+    if ":" in text:
+        can_id, payload = text.split(":", 1)
+        if "/" in payload:
+            value, mask = payload.split("/", 1)
+            matcher = PayloadMatcher(bytes.fromhex(value), bytes.fromhex(mask))
+        else:
+            matcher = PayloadMatcher(bytes.fromhex(payload))
+    else:
+        can_id = text
+        matcher = None
+    return int(can_id, 16), matcher
+
+
+def positive_int(text):
+    """ Argument type for an integer of at least 1. """
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
+
+
+def add_arguments(parser):
+    """ Add trigger capture options to an argument parser. """
+    group = parser.add_argument_group("trigger capture")
+    group.add_argument(
+        "--trigger",
+        action="append",
+        default=[],
+        help="trigger on ID[:DATA[/MASK]], all in hex, may be repeated",
+    )
+    group.add_argument(
+        "--trigger-error", action="store_true", help="trigger on error frames"
+    )
+    group.add_argument(
+        "--trigger-rate", type=int, help="trigger above this many frames per second"
+    )
+    group.add_argument("--capture-dir", default=".", help="directory for captures")
+    group.add_argument(
+        "--pre-frames",
+        type=positive_int,
+        default=10000,
+        help="frames to keep before the trigger, including the trigger frame",
+    )
+    group.add_argument("--pre-seconds", type=float)
+    group.add_argument("--post-frames", type=int, default=1000)
+    group.add_argument("--post-seconds", type=float, default=1.0)
+
+
+def setup_from_args(args, can_link):
+    """ Create a trigger capture from the parsed arguments, if any. """
+    if not (args.trigger or args.trigger_error or args.trigger_rate):
+        return
+
+    capture = TriggerCapture(
+        directory=args.capture_dir,
+        pre_frames=args.pre_frames,
+        pre_seconds=args.pre_seconds,
+        post_frames=args.post_frames,
+        post_seconds=args.post_seconds,
+    )
+    for text in args.trigger:
+        can_id, matcher = parse_trigger(text)
+        capture.add_id_trigger(can_id, matcher)
+    capture.trigger_on_error = args.trigger_error
+    capture.max_rate = args.trigger_rate
+    capture.attach(can_link)
+    return capture
@@ -0,0 +1,367 @@
+""" Columnar export of captures, and vectorized queries on them.
+
+Captures in the candump text format are converted into columns:
+
+- timestamp_ns: nanoseconds since the epoch, in local time (int64)
+- bus: bus number (uint8)
+- id: can id (uint32)
+- flags: FLAG_* bits (uint8)
+- dlc: payload length (uint8)
+- payload: N x width matrix (uint8), with width 8 or 64
+
+Older captures only have the time of day. Their timestamps count from
+the midnight before the first frame, and a jump back in time is taken as
+a day rollover.
+
+Conversion is streamed in chunks, so memory use is bounded by the chunk
+size. Chunks are written as numbered .npz files into a directory, or as
+row groups into a Parquet file when pyarrow is available.
+
+Example usage:
+
+    $ python candump.py socketcan:vcan0 > capture.log
+    $ python columnar.py convert capture.log capture_npz
+    $ python columnar.py stats capture_npz
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import socket
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FLAG_FD = 0x1
+FLAG_BRS = 0x2
+FLAG_ERROR = 0x4
+
+COLUMNS = ["timestamp_ns", "bus", "id", "flags", "dlc", "payload"]
+
+DAY_NS = 86400 * 1000000000
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+_kinds = {
+    "CAN msg": 0,
+    "CAN FD msg": FLAG_FD,
+    "CAN FD BRS msg": FLAG_FD | FLAG_BRS,
+}
+
+
+def parse_line(line):
+    """ Parse a line of candump output.
+
+    Returns a tuple of timestamp_ns, id, flags and data, or None when the
+    line is not a frame. Without a date, timestamp_ns is the time of day.
+    """
+    kind, sep, rest = line.partition(" ID=")
+    if not sep or kind not in _kinds:
+        return
+    flags = _kinds[kind]
+    can_id, _, rest = rest.partition(" LEN=")
+    length, _, rest = rest.partition(" DATA=")
+    length = int(length)
+    tokens = rest.split()
+    data = bytes.fromhex("".join(tokens[:length]))
+
+    timestamp_ns = 0
+    stamp = tokens[length:]
+    if len(stamp) == 2:
+        year, month, day = stamp[0].split("-")
+        days = datetime.date(int(year), int(month), int(day)).toordinal()
+        timestamp_ns = (days - _EPOCH_ORDINAL) * DAY_NS
+        stamp = stamp[1:]
+    if stamp:
+        hours, minutes, seconds = stamp[0].split(":")
+        seconds, _, micros = seconds.partition(".")
+        seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        timestamp_ns += seconds * 1000000000 + int(micros or 0) * 1000
+
+    can_id = int(can_id, 16)
+    if can_id & socket.CAN_ERR_FLAG:
+        flags |= FLAG_ERROR
+    can_id &= socket.CAN_EFF_MASK
+    return timestamp_ns, can_id, flags, data
+
+
+def iter_chunks(lines, chunk_size=1000000, bus=0, width=8):
+    """ Convert lines of candump output into chunks of columns. """
+    if width not in (8, 64):
+        raise ValueError("Payload width must be 8 or 64")
+
+    def make_chunk():
+        count = len(timestamps)
+        return {
+            "timestamp_ns": np.array(timestamps, dtype=np.int64),
+            "bus": np.full(count, bus, dtype=np.uint8),
+            "id": np.array(ids, dtype=np.uint32),
+            "flags": np.array(flags, dtype=np.uint8),
+            "dlc": np.array(dlcs, dtype=np.uint8),
+            "payload": np.frombuffer(bytes(payload), dtype=np.uint8).reshape(
+                count, width
+            ),
+        }
+
+    # Day rollover of time of day timestamps, carried across chunks:
+    day_offset = 0
+    last_time = 0
+
+    timestamps, ids, flags, dlcs, payload = [], [], [], [], bytearray()
+    for line in lines:
+        frame = parse_line(line)
+        if frame is None:
+            continue
+        timestamp_ns, can_id, frame_flags, data = frame
+        if timestamp_ns < DAY_NS:
+            # A time of day only. Allow for frames slightly out of order,
+            # but a jump back of more than half a day passed midnight:
+            if timestamp_ns < last_time - DAY_NS // 2:
+                day_offset += DAY_NS
+            last_time = timestamp_ns
+            timestamp_ns += day_offset
+        if len(data) > width:
+            raise ValueError("Payload of {} bytes exceeds width".format(len(data)))
+        timestamps.append(timestamp_ns)
+        ids.append(can_id)
+        flags.append(frame_flags)
+        dlcs.append(len(data))
+        payload += data.ljust(width, b"\x00")
+
+        if len(timestamps) == chunk_size:
+            yield make_chunk()
+            timestamps, ids, flags, dlcs, payload = [], [], [], [], bytearray()
+
+    if timestamps:
+        yield make_chunk()
+
+
+def write_npz(chunks, directory):
+    """ Write chunks as numbered .npz files into a directory. """
+    os.makedirs(directory, exist_ok=True)
+    count = 0
+    for number, chunk in enumerate(chunks):
+        filename = os.path.join(directory, "part-{:05}.npz".format(number))
+        np.savez(filename, **chunk)
+        count += len(chunk["id"])
+    return count
+
+
+def iter_npz(directory):
+    """ Iterate over the chunks in a directory of .npz files. """
+    for filename in sorted(glob.glob(os.path.join(directory, "part-*.npz"))):
+        with np.load(filename) as chunk:
+            yield {name: chunk[name] for name in COLUMNS}
+
+
+def write_parquet(chunks, filename):
+    """ Write chunks as row groups into a Parquet file. Requires pyarrow. """
+    if pyarrow is None:
+        raise RuntimeError("Writing Parquet requires pyarrow")
+
+    writer = None
+    count = 0
+    for chunk in chunks:
+        payload = chunk["payload"]
+        columns = [pyarrow.array(chunk[name]) for name in COLUMNS[:-1]]
+        columns.append(
+            pyarrow.FixedSizeListArray.from_arrays(
+                pyarrow.array(payload.ravel()), payload.shape[1]
+            )
+        )
+        table = pyarrow.Table.from_arrays(columns, names=COLUMNS)
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+        writer.write_table(table)
+        count += len(payload)
+    if writer is not None:
+        writer.close()
+    return count
+
+
+def iter_parquet(filename):
+    """ Iterate over the row groups of a Parquet file. Requires pyarrow. """
+    if pyarrow is None:
+        raise RuntimeError("Reading Parquet requires pyarrow")
+
+    parquet_file = pyarrow.parquet.ParquetFile(filename)
+    for index in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(index)
+        chunk = {name: table.column(name).to_numpy() for name in COLUMNS[:-1]}
+        payload = table.column("payload").combine_chunks()
+        width = payload.type.list_size
+        chunk["payload"] = payload.flatten().to_numpy().reshape(-1, width)
+        yield chunk
+
+
+def load(path):
+    """ Load a complete capture, from a .npz directory or Parquet file. """
+    if os.path.isdir(path):
+        chunks = list(iter_npz(path))
+    else:
+        chunks = list(iter_parquet(path))
+    return concatenate(chunks)
+
+
+def concatenate(chunks):
+    """ Join chunks of columns into one set of columns. """
+    if not chunks:
+        return {
+            "timestamp_ns": np.zeros(0, dtype=np.int64),
+            "bus": np.zeros(0, dtype=np.uint8),
+            "id": np.zeros(0, dtype=np.uint32),
+            "flags": np.zeros(0, dtype=np.uint8),
+            "dlc": np.zeros(0, dtype=np.uint8),
+            "payload": np.zeros((0, 8), dtype=np.uint8),
+        }
+    return {name: np.concatenate([c[name] for c in chunks]) for name in COLUMNS}
+
+
+def select(columns, mask):
+    """ Select the rows of the columns given by a boolean mask. """
+    return {name: values[mask] for name, values in columns.items()}
+
+
+def filter_frames(columns, ids=None, start_ns=None, end_ns=None, bus=None):
+    """ Select frames by can id, time range [start_ns, end_ns) and bus. """
+    mask = np.ones(len(columns["id"]), dtype=bool)
+    if ids is not None:
+        mask &= np.isin(columns["id"], np.asarray(ids, dtype=np.uint32))
+    if start_ns is not None:
+        mask &= columns["timestamp_ns"] >= start_ns
+    if end_ns is not None:
+        mask &= columns["timestamp_ns"] < end_ns
+    if bus is not None:
+        mask &= columns["bus"] == bus
+    return select(columns, mask)
+
+
+def period_stats(columns):
+    """ Calculate statistics of the period between frames, per can id.
+
+    Returns a dict of arrays: id, count, and mean, std, min and max of
+    the period in nanoseconds. The statistics are NaN for ids with a
+    single frame.
+    """
+    order = np.lexsort((columns["timestamp_ns"], columns["id"]))
+    ids = columns["id"][order]
+    timestamps = columns["timestamp_ns"][order]
+
+    unique_ids, counts = np.unique(ids, return_counts=True)
+    groups = np.repeat(np.arange(len(unique_ids)), counts)
+
+    # Only periods between frames of the same id are valid:
+    valid = groups[1:] == groups[:-1]
+    periods = np.diff(timestamps)[valid].astype(np.float64)
+    period_groups = groups[1:][valid]
+    period_counts = counts - 1
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sums = np.bincount(period_groups, periods, minlength=len(unique_ids))
+        mean = sums / period_counts
+        deviations = (periods - mean[period_groups]) ** 2
+        squares = np.bincount(period_groups, deviations, minlength=len(unique_ids))
+        std = np.sqrt(squares / period_counts)
+
+    # The periods are sorted by id, so each id is a contiguous segment:
+    minimum = np.full(len(unique_ids), np.nan)
+    maximum = np.full(len(unique_ids), np.nan)
+    has_periods = period_counts > 0
+    if len(periods):
+        offsets = np.cumsum(period_counts) - period_counts
+        minimum[has_periods] = np.minimum.reduceat(periods, offsets[has_periods])
+        maximum[has_periods] = np.maximum.reduceat(periods, offsets[has_periods])
+
+    return {
+        "id": unique_ids,
+        "count": counts,
+        "mean_ns": mean,
+        "std_ns": std,
+        "min_ns": minimum,
+        "max_ns": maximum,
+    }
+
+
+def extract_signal(
+    columns, start, size, byteorder="little", signed=False, scale=1.0, offset=0.0
+):
+    """ Extract a signal of 1, 2, 4 or 8 payload bytes for all frames.
+
+    The raw integer value is returned, or the physical value
+    raw * scale + offset when a scale or offset is given.
+    """
+    if size not in (1, 2, 4, 8):
+        raise ValueError("Signal size must be 1, 2, 4 or 8 bytes")
+    width = columns["payload"].shape[1]
+    if start < 0 or start + size > width:
+        raise ValueError(
+            "Signal of {} bytes at {} exceeds the payload width of {}".format(
+                size, start, width
+            )
+        )
+    dtype = np.dtype(
+        "{}{}{}".format(
+            "<" if byteorder == "little" else ">", "i" if signed else "u", size
+        )
+    )
+    raw_bytes = np.ascontiguousarray(columns["payload"][:, start : start + size])
+    raw = raw_bytes.view(dtype)[:, 0]
+    if scale == 1.0 and offset == 0.0:
+        return raw
+    else:
+        return raw * scale + offset
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser(
+        "convert", help="convert candump output into columns"
+    )
+    convert_parser.add_argument("capture", help="candump output file")
+    convert_parser.add_argument(
+        "output", help="directory for .npz files, or a .parquet file"
+    )
+    convert_parser.add_argument("--bus", type=int, default=0)
+    convert_parser.add_argument("--width", type=int, choices=[8, 64], default=8)
+    convert_parser.add_argument("--chunk-size", type=int, default=1000000)
+
+    stats_parser = subparsers.add_parser("stats", help="show period statistics")
+    stats_parser.add_argument("input", help="directory of .npz files or .parquet file")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        with open(args.capture) as f:
+            chunks = iter_chunks(
+                f, chunk_size=args.chunk_size, bus=args.bus, width=args.width
+            )
+            if args.output.endswith(".parquet"):
+                count = write_parquet(chunks, args.output)
+            else:
+                count = write_npz(chunks, args.output)
+        print("Converted {} frames".format(count))
+    elif args.command == "stats":
+        stats = period_stats(load(args.input))
+        print("ID        COUNT   MEAN [ms]    STD [ms]    MIN [ms]    MAX [ms]")
+        for row in range(len(stats["id"])):
+            print(
+                "{:8X} {:6} {:11.3f} {:11.3f} {:11.3f} {:11.3f}".format(
+                    stats["id"][row],
+                    stats["count"][row],
+                    stats["mean_ns"][row] * 1e-6,
+                    stats["std_ns"][row] * 1e-6,
+                    stats["min_ns"][row] * 1e-6,
+                    stats["max_ns"][row] * 1e-6,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,10 @@ A PyQt5 based CAN bus explorer utility.
 """
 
 import argparse
+import collections
 import sys
 import datetime
+import threading
 
 use_pyqt = False
 
@@ -22,13 +24,27 @@ else:
     from PySide2.QtCore import Signal
 
 import logging
-from can_link import CanMessage, make_can_link
+import time
+from can_link import CanMessage, make_can_link, fd_length
+import can_errors
+import capture
+import isotp
+import metrics
+from metrics import registry, timed
 
 if not use_pyqt:
     from busload import BusLoadWidget
 
 logger = logging.getLogger("can-explorer")
 
+delivery_latency = registry.histogram(
+    "qt_delivery_latency_seconds", "Time from frame reception to GUI delivery"
+)
+model_flush_time = registry.histogram(
+    "model_flush_seconds", "Time to flush a batch of frames into a message model"
+)
+paint_time = registry.histogram("table_paint_seconds", "Message table paint time")
+
 
 class AbstractMessageModel(QtCore.QAbstractTableModel):
     """ An abstract model for messages.
@@ -40,6 +56,8 @@ class AbstractMessageModel(QtCore.QAbstractTableModel):
     """
 
     FADE_TIME = 2.0
+    FADE_STEPS = 20
+    DISPLAY_CACHE_SIZE = 256
 
     def __init__(self):
         super().__init__()
@@ -50,6 +68,20 @@ class AbstractMessageModel(QtCore.QAbstractTableModel):
             ("Can ID", "id", 30),
             ("Payload", "hexdata", 80),
         ]
+
+        # Rendering cache:
+        # - row -> (message, display strings) for recently painted rows,
+        #   least recently used rows are evicted
+        # - a palette of quantized fade brushes, indexed by age bucket
+        # - a single 'now' snapshot, refreshed once per fade cycle
+        self._display_cache = collections.OrderedDict()
+        self._fade_step = self.FADE_TIME / (self.FADE_STEPS - 1)
+        self._fade_brushes = [
+            QtGui.QBrush(self.age_to_color(step * self._fade_step))
+            for step in range(self.FADE_STEPS)
+        ]
+        self._now = datetime.datetime.now()
+
         self._update_timer = QtCore.QTimer()
         self._update_timer.timeout.connect(self._update_color)
         self._update_timer.start(100)
@@ -78,11 +110,54 @@ class AbstractMessageModel(QtCore.QAbstractTableModel):
         raise NotImplementedError()
 
     def _update_color(self):
-        roles = [Qt.BackgroundRole]
+        previous = self._now
+        self._now = datetime.datetime.now()
+        # Include rows which faded out since the previous update, so that
+        # they are painted fully faded once:
+        max_age = self.FADE_TIME + (self._now - previous).total_seconds()
+        rows = self.fading_rows(max_age)
+
+        # Repaint all fading rows with a single signal:
+        if rows is not None:
+            first_row, last_row = rows
+            from_index = self.index(first_row, 0)
+            to_index = self.index(last_row, len(self._headers) - 1)
+            self.dataChanged.emit(from_index, to_index, [Qt.BackgroundRole])
+
+    def fading_rows(self, max_age):
+        """ Get the first and last row younger than max_age, or None. """
+        first_row = last_row = None
         for row in range(self.get_row_count()):
             message = self.get_message(row)
-            if message.age < self.FADE_TIME:
-                self.row_changed(row, roles)
+            if self.message_age(message) < max_age:
+                if first_row is None:
+                    first_row = row
+                last_row = row
+        if first_row is not None:
+            return first_row, last_row
+
+    def message_age(self, message):
+        """ Age of the message relative to the current repaint cycle. """
+        if message.timestamp is None:
+            return 0.0
+        else:
+            return (self._now - message.timestamp).total_seconds()
+
+    def display_values(self, row, message):
+        """ Get the formatted column strings of the message at the given row. """
+        entry = self._display_cache.get(row)
+        if entry is None or entry[0] is not message:
+            values = [str(getattr(message, header[1])) for header in self._headers]
+            entry = (message, values)
+            self._display_cache[row] = entry
+            if len(self._display_cache) > self.DISPLAY_CACHE_SIZE:
+                self._display_cache.popitem(last=False)
+        else:
+            self._display_cache.move_to_end(row)
+        return entry[1]
+
+    def clear_display_cache(self):
+        self._display_cache = collections.OrderedDict()
 
     def row_changed(self, row, roles):
         from_index = self.index(row, 0)
@@ -98,12 +173,18 @@ class AbstractMessageModel(QtCore.QAbstractTableModel):
         message = self.get_message(row)
 
         if role == Qt.DisplayRole:
-            prop_name = self._headers[column][1]
-            value = str(getattr(message, prop_name))
-            return value
+            return self.display_values(row, message)[column]
         elif role == Qt.BackgroundRole:
-            color = self.age_to_color(message.age)
-            return QtGui.QBrush(color)
+            return self.age_to_brush(self.message_age(message))
+
+    def age_to_brush(self, age):
+        # Same quantization as the palette, brush n is for age n * fade step:
+        step = int(age / self._fade_step)
+        if step < 0:
+            step = 0
+        elif step >= self.FADE_STEPS:
+            step = self.FADE_STEPS - 1
+        return self._fade_brushes[step]
 
     def age_to_color(self, age):
         if age > self.FADE_TIME:
@@ -129,21 +210,38 @@ class LastMessageModel(AbstractMessageModel):
         super().__init__()
         self._messages = {}  # can_id -> row, message
         self._message_ids = []
-        can_connection.message_received.connect(self.on_message)
-
-    def on_message(self, message):
-        if message.id in self._messages:
-            logger.debug("Update message in model %s", message)
-            row = self._messages[message.id][0]
-            self._messages[message.id] = (row, message)
-            self.row_changed(row, [Qt.DisplayRole])
-        else:
-            logger.debug("Add message in model %s", message)
+        can_connection.messages_received.connect(self.on_messages)
+
+    @timed(model_flush_time)
+    def on_messages(self, messages):
+        first_row = last_row = None
+        new_messages = {}
+        for message in messages:
+            if message.id in self._messages:
+                row = self._messages[message.id][0]
+                self._messages[message.id] = (row, message)
+                if first_row is None or row < first_row:
+                    first_row = row
+                if last_row is None or row > last_row:
+                    last_row = row
+            else:
+                new_messages[message.id] = message
+
+        if first_row is not None:
+            logger.debug("Update rows %s to %s in model", first_row, last_row)
+            from_index = self.index(first_row, 0)
+            to_index = self.index(last_row, len(self._headers) - 1)
+            self.dataChanged.emit(from_index, to_index, [Qt.DisplayRole])
+
+        if new_messages:
+            logger.debug("Add %s messages in model", len(new_messages))
             parent = QtCore.QModelIndex()
             row = len(self._message_ids)
-            self.beginInsertRows(parent, row, row)
-            self._messages[message.id] = (row, message)
-            self._message_ids.append(message.id)
+            self.beginInsertRows(parent, row, row + len(new_messages) - 1)
+            for can_id, message in new_messages.items():
+                self._messages[can_id] = (row, message)
+                self._message_ids.append(can_id)
+                row += 1
             self.endInsertRows()
 
     def get_message(self, row):
@@ -154,6 +252,7 @@ class LastMessageModel(AbstractMessageModel):
         self.beginResetModel()
         self._messages = {}
         self._message_ids = []
+        self.clear_display_cache()
         self.endResetModel()
 
     def get_row_count(self):
@@ -169,19 +268,21 @@ class MessageLogModel(AbstractMessageModel):
     def __init__(self, can_connection):
         super().__init__()
         self._messages = []
-        can_connection.message_received.connect(self.on_message)
+        can_connection.messages_received.connect(self.on_messages)
 
-    def on_message(self, message):
-        logger.debug("Add message in model %s", message)
+    @timed(model_flush_time)
+    def on_messages(self, messages):
+        logger.debug("Add %s messages in model", len(messages))
         parent = QtCore.QModelIndex()
         row = len(self._messages)
-        self.beginInsertRows(parent, row, row)
-        self._messages.append(message)
+        self.beginInsertRows(parent, row, row + len(messages) - 1)
+        self._messages.extend(messages)
         self.endInsertRows()
 
     def clear(self):
         self.beginResetModel()
         self._messages = []
+        self.clear_display_cache()
         self.endResetModel()
 
     def get_row_count(self):
@@ -191,22 +292,42 @@ class MessageLogModel(AbstractMessageModel):
         message = self._messages[row]
         return message
 
+    def fading_rows(self, max_age):
+        # The log is in time order, so only the last rows can be fading:
+        count = len(self._messages)
+        row = count
+        while row > 0 and self.message_age(self._messages[row - 1]) < max_age:
+            row -= 1
+        if row < count:
+            return row, count - 1
+
 
 class CanConnection(QtCore.QObject):
     """ A can connection hub.
 
     Use this class to communicate over CAN.
+
+    Received messages are collected by the receiver thread, and
+    delivered in batches to the GUI thread via messages_received.
     """
 
     connection_opened = Signal(bool)
     connection_closed = Signal(bool)
-    message_received = Signal(CanMessage)
+    messages_received = Signal(list)
+    message_sent = Signal(CanMessage, float)
+    _messages_pending = Signal()
 
     def __init__(self, can_link):
         super().__init__()
         self.can_link = can_link
         self.can_link.attach_recv_callback(self._on_message)
+        self.can_link.attach_sent_callback(self.message_sent.emit)
         self._connected = False
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        self._messages_pending.connect(self._flush_pending)
+        if registry.enabled:
+            self.messages_received.connect(self._on_delivered)
 
     @property
     def connected(self):
@@ -235,7 +356,27 @@ class CanConnection(QtCore.QObject):
             logger.error("Error, not connected")
 
     def _on_message(self, message):
-        self.message_received.emit(message)
+        # Called from the receiver thread. Only the first message of a
+        # batch posts a wakeup event to the GUI thread.
+        with self._pending_lock:
+            self._pending.append(message)
+            wakeup = len(self._pending) == 1
+        if wakeup:
+            self._messages_pending.emit()
+
+    def _flush_pending(self):
+        with self._pending_lock:
+            messages = self._pending
+            self._pending = []
+        if messages:
+            self.messages_received.emit(messages)
+
+    def _on_delivered(self, messages):
+        now = datetime.datetime.now()
+        for message in messages:
+            if message.timestamp is not None:
+                latency = now - message.timestamp
+                delivery_latency.observe(latency.total_seconds())
 
 
 class ConnectionWidget(QtWidgets.QWidget):
@@ -293,22 +434,35 @@ class SendMessageWidget(QtWidgets.QWidget):
         self.length_edit = QtWidgets.QLineEdit("6")
         grid_layout.addWidget(self.length_edit, 1, 1)
 
-        # Data:
+        # Data, 8 bytes per row, up to 64 bytes for CAN FD:
         data_label = QtWidgets.QLabel("Data:")
         grid_layout.addWidget(data_label, 0, 2, 1, 8)
-        self.data_edits = []
         for i in range(8):
             data_label = QtWidgets.QLabel(str(i))
             data_label.setAlignment(Qt.AlignCenter)
-            grid_layout.addWidget(data_label, 2, 2 + i)
-            data_edit = QtWidgets.QLineEdit("{:02X}".format(i + 1))
+            grid_layout.addWidget(data_label, 9, 2 + i)
+        self.data_edits = []
+        for i in range(64):
+            data_edit = QtWidgets.QLineEdit("{:02X}".format((i + 1) & 0xFF))
             data_edit.setInputMask("HH")
-            grid_layout.addWidget(data_edit, 1, 2 + i)
+            data_edit.setVisible(i < 8)
+            grid_layout.addWidget(data_edit, 1 + i // 8, 2 + i % 8)
             self.data_edits.append(data_edit)
 
+        # CAN FD flags:
+        self.fd_check = QtWidgets.QCheckBox("FD")
+        self.fd_check.toggled.connect(self.on_fd_toggled)
+        grid_layout.addWidget(self.fd_check, 0, 10)
+        self.brs_check = QtWidgets.QCheckBox("BRS")
+        self.brs_check.setEnabled(False)
+        grid_layout.addWidget(self.brs_check, 1, 10)
+
         layout.addLayout(grid_layout)
         self.send_button = QtWidgets.QPushButton("Send!")
         layout.addWidget(self.send_button)
+        self.status_label = QtWidgets.QLabel()
+        layout.addWidget(self.status_label)
+        can_connection.message_sent.connect(self.on_sent)
         layout.addStretch()
 
         # layout_horizontal = QtWidgets.QHBoxLayout()
@@ -323,13 +477,30 @@ class SendMessageWidget(QtWidgets.QWidget):
         can_message = self.create_can_message()
         self.can_connection.send(can_message)
 
+    def on_fd_toggled(self, fd):
+        self.brs_check.setEnabled(fd)
+        for data_edit in self.data_edits[8:]:
+            data_edit.setVisible(fd)
+
+    def on_sent(self, message, latency):
+        backlog = self.can_connection.can_link.send_backlog
+        self.status_label.setText(
+            "Sent ID {:X} in {:.1f} ms, {} waiting".format(
+                message.id, latency * 1000, backlog
+            )
+        )
+
     def create_can_message(self):
         """ Create a nice can message based on given inputs. """
         try:
             id = int(self.id_edit.text(), 16)
             size = int(self.length_edit.text())
             assert size >= 0
-            if size > 8:
+            fd = self.fd_check.isChecked()
+            brs = fd and self.brs_check.isChecked()
+            if fd:
+                size = fd_length(min(size, 64))
+            elif size > 8:
                 size = 8
             data = bytearray()
             for i in range(size):
@@ -339,10 +510,18 @@ class SendMessageWidget(QtWidgets.QWidget):
         except ValueError as ex:
             print("Invalid data!", ex)
         else:
-            can_message = CanMessage(id, data)
+            can_message = CanMessage(id, data, fd=fd, brs=brs)
             return can_message
 
 
+class MessageTableView(QtWidgets.QTableView):
+    """ Table view which measures its paint time. """
+
+    @timed(paint_time)
+    def paintEvent(self, event):
+        super().paintEvent(event)
+
+
 class MessageTableWidget(QtWidgets.QWidget):
     """ A widget with a history of can messages. """
 
@@ -352,7 +531,7 @@ class MessageTableWidget(QtWidgets.QWidget):
         self.clear_button = QtWidgets.QPushButton("Clear!")
         self.clear_button.clicked.connect(self.on_clear)
         layout.addWidget(self.clear_button)
-        self.table_view = QtWidgets.QTableView()
+        self.table_view = MessageTableView()
         layout.addWidget(self.table_view)
         self.setLayout(layout)
         self.table_view.setModel(message_model)
@@ -361,6 +540,176 @@ class MessageTableWidget(QtWidgets.QWidget):
         self.message_model.clear()
 
 
+class DiagnosticsWidget(QtWidgets.QWidget):
+    """ A widget showing the runtime metrics. """
+
+    def __init__(self):
+        super().__init__()
+        layout = QtWidgets.QVBoxLayout()
+        if not registry.enabled:
+            label = QtWidgets.QLabel("Metrics are disabled, use --metrics to enable.")
+            layout.addWidget(label)
+        self.table_widget = QtWidgets.QTableWidget(0, 2)
+        self.table_widget.setHorizontalHeaderLabels(["Metric", "Value"])
+        self.table_widget.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.table_widget)
+        self.setLayout(layout)
+
+        self._prev_values = {}
+        self._prev_time = time.monotonic()
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.on_timer)
+        if registry.enabled:
+            self.timer.start(1000)
+
+    def on_timer(self):
+        now = time.monotonic()
+        timespan = now - self._prev_time
+        self._prev_time = now
+
+        rows = []
+        for metric in registry:
+            if isinstance(metric, metrics.Counter):
+                prev_value = self._prev_values.get(metric.name, metric.value)
+                self._prev_values[metric.name] = metric.value
+                rate = (metric.value - prev_value) / timespan
+                value = "{} ({:.1f}/s)".format(metric.value, rate)
+            elif isinstance(metric, metrics.Histogram):
+                value = "n={} mean={:.1f}us p99<={:.1f}us".format(
+                    metric.count, metric.mean * 1e6, metric.quantile(0.99) * 1e6
+                )
+            else:
+                value = str(metric.value)
+            rows.append((metric.help, value))
+
+        self.table_widget.setRowCount(len(rows))
+        for row, (name, value) in enumerate(rows):
+            self.table_widget.setItem(row, 0, QtWidgets.QTableWidgetItem(name))
+            self.table_widget.setItem(row, 1, QtWidgets.QTableWidgetItem(value))
+
+
+class ErrorWidget(QtWidgets.QWidget):
+    """ A widget showing error frame counts, rates and bus state changes. """
+
+    def __init__(self, can_connection):
+        super().__init__()
+        self.error_channel = can_connection.can_link.errors
+        layout = QtWidgets.QVBoxLayout()
+
+        names = [name for _, name in can_errors.ERROR_CLASS_NAMES]
+        self.table_widget = QtWidgets.QTableWidget(len(names), 3)
+        self.table_widget.setHorizontalHeaderLabels(["Class", "Count", "Rate"])
+        self.table_widget.horizontalHeader().setStretchLastSection(True)
+        self._rows = {}
+        for row, name in enumerate(names):
+            self.table_widget.setItem(row, 0, QtWidgets.QTableWidgetItem(name))
+            self._rows[name] = row
+        layout.addWidget(self.table_widget)
+
+        form_layout = QtWidgets.QFormLayout()
+        self.dropped_label = QtWidgets.QLabel("0")
+        form_layout.addRow("Dropped", self.dropped_label)
+        self.bus_off_label = QtWidgets.QLabel("-")
+        form_layout.addRow("Last bus off", self.bus_off_label)
+        self.error_passive_label = QtWidgets.QLabel("-")
+        form_layout.addRow("Last error passive", self.error_passive_label)
+        self.error_active_label = QtWidgets.QLabel("-")
+        form_layout.addRow("Last back to active", self.error_active_label)
+        self.last_error_label = QtWidgets.QLabel("-")
+        form_layout.addRow("Last error", self.last_error_label)
+        layout.addLayout(form_layout)
+        self.setLayout(layout)
+
+        self._prev_counts = {}
+        self._prev_time = time.monotonic()
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.on_timer)
+        self.timer.start(500)
+
+    def on_timer(self):
+        now = time.monotonic()
+        timespan = now - self._prev_time
+        self._prev_time = now
+
+        for message, errors in self.error_channel.get_all():
+            timestamp = message.fancytimestamp
+            for error in errors:
+                if isinstance(error, can_errors.BusOffError):
+                    self.bus_off_label.setText(timestamp)
+                elif isinstance(error, can_errors.ControllerError):
+                    if error.error_passive:
+                        self.error_passive_label.setText(timestamp)
+                    if error.error_active:
+                        self.error_active_label.setText(timestamp)
+                elif isinstance(error, can_errors.RestartedError):
+                    self.error_active_label.setText(timestamp)
+            if errors:
+                description = "; ".join(
+                    "{} {}".format(type(error).__name__, error) for error in errors
+                )
+                self.last_error_label.setText("{} {}".format(timestamp, description))
+
+        for name, row in self._rows.items():
+            count = self.error_channel.counts[name]
+            rate = (count - self._prev_counts.get(name, 0)) / timespan
+            self._prev_counts[name] = count
+            self.table_widget.setItem(row, 1, QtWidgets.QTableWidgetItem(str(count)))
+            self.table_widget.setItem(
+                row, 2, QtWidgets.QTableWidgetItem("{:.1f}/s".format(rate))
+            )
+        self.dropped_label.setText(str(self.error_channel.dropped))
+
+
+class IsoTpWidget(QtWidgets.QWidget):
+    """ A widget showing reassembled ISO-TP PDUs. """
+
+    MAX_DATA = 64
+
+    pdu_received = Signal(object)
+
+    def __init__(self, isotp_layer):
+        super().__init__()
+        self.isotp_layer = isotp_layer
+        layout = QtWidgets.QVBoxLayout()
+        self.clear_button = QtWidgets.QPushButton("Clear!")
+        self.clear_button.clicked.connect(self.on_clear)
+        layout.addWidget(self.clear_button)
+        self.table_widget = QtWidgets.QTableWidget(0, 4)
+        self.table_widget.setHorizontalHeaderLabels(
+            ["Timestamp", "Session", "Length", "Payload"]
+        )
+        self.table_widget.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.table_widget)
+        self.setLayout(layout)
+
+        # PDUs are reassembled on the receiver thread:
+        self.pdu_received.connect(self.on_pdu)
+        isotp_layer.attach_pdu_callback(self.pdu_received.emit)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(isotp_layer.check_timeouts)
+        self.timer.start(500)
+
+    def on_pdu(self, pdu):
+        data = pdu.data[: self.MAX_DATA]
+        payload = " ".join("{:02X}".format(b) for b in data)
+        if len(pdu.data) > self.MAX_DATA:
+            payload += " ..."
+        values = [
+            pdu.timestamp.strftime("%H:%M:%S.%f"),
+            "{:X} -> {:X}".format(pdu.rx_id, pdu.tx_id),
+            str(len(pdu.data)),
+            payload,
+        ]
+        row = self.table_widget.rowCount()
+        self.table_widget.insertRow(row)
+        for column, value in enumerate(values):
+            self.table_widget.setItem(row, column, QtWidgets.QTableWidgetItem(value))
+
+    def on_clear(self):
+        self.table_widget.setRowCount(0)
+
+
 class CanExplorer(QtWidgets.QMainWindow):
     """ Main window for the CAN explorer.
 
@@ -370,7 +719,7 @@ class CanExplorer(QtWidgets.QMainWindow):
     - Message log
     """
 
-    def __init__(self, can_connection):
+    def __init__(self, can_connection, isotp_layer):
         super().__init__()
         self.settings = QtCore.QSettings("lcfos", "can-bus-explorer")
 
@@ -429,6 +778,30 @@ class CanExplorer(QtWidgets.QMainWindow):
             self.addDockWidget(Qt.BottomDockWidgetArea, self.busload_dock_widget)
             self.view_menu.addAction(self.busload_dock_widget.toggleViewAction())
 
+        # Reassembled ISO-TP PDUs:
+        self.isotp_widget = IsoTpWidget(isotp_layer)
+        self.isotp_dock_widget = QtWidgets.QDockWidget("ISO-TP")
+        self.isotp_dock_widget.setObjectName("IsoTpDock")
+        self.isotp_dock_widget.setWidget(self.isotp_widget)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.isotp_dock_widget)
+        self.view_menu.addAction(self.isotp_dock_widget.toggleViewAction())
+
+        # Error frames:
+        self.error_widget = ErrorWidget(self.can_connection)
+        self.error_dock_widget = QtWidgets.QDockWidget("Errors")
+        self.error_dock_widget.setObjectName("ErrorDock")
+        self.error_dock_widget.setWidget(self.error_widget)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.error_dock_widget)
+        self.view_menu.addAction(self.error_dock_widget.toggleViewAction())
+
+        # Diagnostics:
+        self.diagnostics_widget = DiagnosticsWidget()
+        self.diagnostics_dock_widget = QtWidgets.QDockWidget("Diagnostics")
+        self.diagnostics_dock_widget.setObjectName("DiagnosticsDock")
+        self.diagnostics_dock_widget.setWidget(self.diagnostics_widget)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.diagnostics_dock_widget)
+        self.view_menu.addAction(self.diagnostics_dock_widget.toggleViewAction())
+
         # Add menu:
         self.help_menu = self.menuBar().addMenu("Help")
         self.about_action = QtWidgets.QAction("About")
@@ -477,6 +850,22 @@ def main():
     parser.add_argument(
         "interface", help="Specify the interface, for example socketcan:can0"
     )
+    parser.add_argument(
+        "--isotp",
+        action="append",
+        default=[],
+        metavar="RX:TX",
+        help="show ISO-TP PDUs of this pair of can ids in hex, may be repeated",
+    )
+    parser.add_argument(
+        "--data-rate-factor",
+        type=float,
+        default=CanMessage.data_rate_factor,
+        help="ratio of the CAN FD data bit rate to the nominal bit rate, "
+        "used for the bus load (default: %(default)s)",
+    )
+    metrics.add_arguments(parser)
+    capture.add_arguments(parser)
     args = parser.parse_args()
 
     logformat = "%(asctime)s | %(levelname)8s | %(name)10.10s | %(message)s"
@@ -486,15 +875,26 @@ def main():
     else:
         level = logging.INFO
     logging.basicConfig(level=level, format=logformat)
+    metrics.setup_from_args(args)
+    if args.data_rate_factor <= 0:
+        parser.error("The data rate factor must be positive")
+    CanMessage.data_rate_factor = args.data_rate_factor
     can_link = make_can_link(args.interface)
+    trigger_capture = capture.setup_from_args(args, can_link)
+    isotp_layer = isotp.IsoTpLayer(can_link)
+    for text in args.isotp:
+        rx_id, tx_id = isotp.parse_session(text)
+        isotp_layer.add_session(rx_id, tx_id, listen_only=True, max_size=0xFFFF)
 
     # Qt part:
     app = QtWidgets.QApplication(sys.argv)
     can_connection = CanConnection(can_link)
-    main_window = CanExplorer(can_connection)
+    main_window = CanExplorer(can_connection, isotp_layer)
     main_window.show()
     can_connection.open()
     app.exec_()
+    if trigger_capture:
+        trigger_capture.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,406 @@
+""" ISO-TP (ISO 15765-2) transport layer on top of a can link.
+
+Segmented PDUs, such as UDS diagnostics, are reassembled per session.
+A session is a pair of can ids: frames are received on rx_id, and flow
+control is sent on tx_id.
+
+Each session reassembles into a preallocated buffer via a memoryview,
+so there is no per-frame concatenation. Only the completed PDU is
+copied out once.
+
+When sending, frames wait for room in the send queue of the can link,
+and the minimum separation time is counted from the moment the previous
+frame was actually sent.
+"""
+
+import datetime
+import logging
+import threading
+import time
+
+from can_link import CanMessage
+
+logger = logging.getLogger("can-explorer")
+
+# Protocol control information types:
+SINGLE_FRAME = 0x0
+FIRST_FRAME = 0x1
+CONSECUTIVE_FRAME = 0x2
+FLOW_CONTROL = 0x3
+
+# Flow status:
+CONTINUE_TO_SEND = 0x0
+WAIT = 0x1
+OVERFLOW = 0x2
+
+
+class IsoTpError(Exception):
+    pass
+
+
+def decode_st_min(value):
+    """ Decode the STmin byte of a flow control frame into seconds. """
+    if value <= 0x7F:
+        return value * 0.001
+    elif 0xF1 <= value <= 0xF9:
+        return (value - 0xF0) * 0.0001
+    else:
+        # Reserved values are treated as the maximum:
+        return 0.127
+
+
+def encode_st_min(st_min):
+    """ Encode a minimum separation time in seconds into a STmin byte. """
+    if st_min <= 0:
+        return 0
+    elif st_min < 0.001:
+        return 0xF0 + max(1, min(9, round(st_min * 10000)))
+    else:
+        return min(0x7F, round(st_min * 1000))
+
+
+class IsoTpPdu:
+    """ A reassembled ISO-TP PDU. """
+
+    def __init__(self, rx_id, tx_id, data, timestamp=None):
+        self.rx_id = rx_id
+        self.tx_id = tx_id
+        self.data = data
+        self.timestamp = timestamp
+
+    def __str__(self):
+        return "ISO-TP PDU {:X}->{:X} LEN={} DATA={}".format(
+            self.rx_id, self.tx_id, len(self.data), self.data.hex().upper()
+        )
+
+
+class IsoTpSession:
+    """ Transfer PDUs between a pair of can ids.
+
+    In listen only mode no flow control is sent, so that traffic between
+    other nodes can be observed.
+    """
+
+    def __init__(
+        self,
+        layer,
+        rx_id,
+        tx_id,
+        listen_only=False,
+        max_size=4095,
+        block_size=0,
+        st_min=0.0,
+        timeout=1.0,
+        padding=None,
+    ):
+        self.layer = layer
+        self.rx_id = rx_id
+        self.tx_id = tx_id
+        self.listen_only = listen_only
+        self.block_size = block_size
+        self.st_min = st_min
+        self.timeout = timeout
+        self.padding = padding
+        self._condition = threading.Condition()
+
+        # Reception state:
+        self._buffer = bytearray(max_size)
+        self._view = memoryview(self._buffer)
+        self._size = None  # None when idle
+        self._offset = 0
+        self._sequence = 0
+        self._block_count = 0
+        self._last_time = 0.0
+        self._first_timestamp = None
+
+        # Transmission state, last received flow control:
+        self._flow_control = None
+        # Frame queued but not yet sent, and the time the last one was sent:
+        self._unsent = None
+        self._sent_time = 0.0
+
+        self.completed = 0
+        self.aborted = 0
+
+    @property
+    def max_size(self):
+        return len(self._buffer)
+
+    def on_frame(self, message):
+        data = message.data
+        if not data:
+            return
+        pci_type = data[0] >> 4
+        with self._condition:
+            if pci_type == SINGLE_FRAME:
+                self._on_single_frame(message)
+            elif pci_type == FIRST_FRAME:
+                self._on_first_frame(message)
+            elif pci_type == CONSECUTIVE_FRAME:
+                self._on_consecutive_frame(message)
+            elif pci_type == FLOW_CONTROL and len(data) >= 3:
+                self._flow_control = (data[0] & 0xF, data[1], decode_st_min(data[2]))
+                self._condition.notify_all()
+
+    def _on_single_frame(self, message):
+        data = message.data
+        size = data[0] & 0xF
+        start = 1
+        if size == 0 and len(data) > 8:
+            # CAN FD escape sequence:
+            size = data[1]
+            start = 2
+        if size == 0 or start + size > len(data):
+            self._abort("invalid single frame")
+            return
+        if self._size is not None:
+            self._abort("interrupted by single frame")
+        self.completed += 1
+        pdu_data = bytes(data[start : start + size])
+        timestamp = message.timestamp
+        self.layer._deliver(IsoTpPdu(self.rx_id, self.tx_id, pdu_data, timestamp))
+
+    def _on_first_frame(self, message):
+        data = message.data
+        if len(data) < 2:
+            self._abort("invalid first frame")
+            return
+        size = ((data[0] & 0xF) << 8) | data[1]
+        start = 2
+        if size == 0:
+            # Escape sequence for PDUs above 4095 bytes:
+            if len(data) < 6:
+                self._abort("invalid first frame")
+                return
+            size = int.from_bytes(data[2:6], "big")
+            start = 6
+        # A first frame is only used for a PDU which does not fit in it:
+        chunk = memoryview(data)[start:]
+        if size <= 7 or size <= len(chunk):
+            self._abort("invalid first frame size {}".format(size))
+            return
+        if self._size is not None:
+            self._abort("interrupted by first frame")
+
+        if size > len(self._buffer):
+            logger.warning("ISO-TP PDU of %s bytes exceeds buffer size", size)
+            self.aborted += 1
+            self._send_flow_control(OVERFLOW)
+            return
+
+        self._view[: len(chunk)] = chunk
+        self._size = size
+        self._offset = len(chunk)
+        self._sequence = 1
+        self._block_count = 0
+        self._last_time = time.monotonic()
+        self._first_timestamp = message.timestamp
+        self._send_flow_control(CONTINUE_TO_SEND)
+
+    def _on_consecutive_frame(self, message):
+        if self._size is None:
+            return
+
+        now = time.monotonic()
+        if now - self._last_time > self.timeout:
+            self._abort("timeout between consecutive frames")
+            return
+        self._last_time = now
+
+        data = message.data
+        if data[0] & 0xF != self._sequence:
+            self._abort("wrong sequence number")
+            return
+        self._sequence = (self._sequence + 1) & 0xF
+
+        chunk_size = min(len(data) - 1, self._size - self._offset)
+        chunk = memoryview(data)[1 : 1 + chunk_size]
+        self._view[self._offset : self._offset + chunk_size] = chunk
+        self._offset += chunk_size
+
+        if self._offset >= self._size:
+            pdu_data = bytes(self._view[: self._size])
+            timestamp = self._first_timestamp
+            self._size = None
+            self.completed += 1
+            self.layer._deliver(IsoTpPdu(self.rx_id, self.tx_id, pdu_data, timestamp))
+        elif self.block_size:
+            self._block_count += 1
+            if self._block_count == self.block_size:
+                self._block_count = 0
+                self._send_flow_control(CONTINUE_TO_SEND)
+
+    def _abort(self, reason):
+        logger.warning("ISO-TP reception %X aborted: %s", self.rx_id, reason)
+        self._size = None
+        self.aborted += 1
+
+    def check_timeout(self):
+        """ Abort a reception which did not make progress in time. """
+        with self._condition:
+            if self._size is not None:
+                if time.monotonic() - self._last_time > self.timeout:
+                    self._abort("timeout")
+
+    def _send_flow_control(self, status):
+        if self.listen_only:
+            return
+        data = bytes(
+            [
+                (FLOW_CONTROL << 4) | status,
+                self.block_size,
+                encode_st_min(self.st_min),
+            ]
+        )
+        # Called on the receiver thread, so do not block on a full queue:
+        try:
+            self._send_frame(data, block=False)
+        except IsoTpError as ex:
+            logger.warning("ISO-TP flow control %X not sent: %s", self.tx_id, ex)
+
+    def _send_frame(self, data, block=True):
+        """ Queue a frame, waiting for room in the send queue if blocking. """
+        if self.padding is not None:
+            data = data.ljust(8, bytes([self.padding]))
+        message = CanMessage(self.tx_id, data)
+        if block:
+            with self._condition:
+                self._unsent = message
+        queued = self.layer.can_link.send(message, block=block, timeout=self.timeout)
+        if not queued:
+            raise IsoTpError("Frame dropped, the send queue is full")
+
+    def on_sent(self, message):
+        with self._condition:
+            if message is self._unsent:
+                self._unsent = None
+                self._sent_time = time.monotonic()
+                self._condition.notify_all()
+
+    def _wait_separation_time(self, st_min):
+        """ Wait until st_min after the previous frame was sent. """
+        with self._condition:
+            sent = self._condition.wait_for(
+                lambda: self._unsent is None, timeout=self.timeout
+            )
+            if not sent:
+                raise IsoTpError("Timeout sending frame")
+            delay = self._sent_time + st_min - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def send(self, payload):
+        """ Send a PDU, segmented at the pace the peer allows.
+
+        Blocks until the last frame has been handed to the can link.
+        Raises IsoTpError when a frame could not be queued.
+        """
+        if self.listen_only:
+            raise IsoTpError("Cannot send in listen only mode")
+
+        size = len(payload)
+        view = memoryview(payload)
+        if size <= 7:
+            self._send_frame(bytes([(SINGLE_FRAME << 4) | size]) + view)
+            return
+
+        if size <= 0xFFF:
+            header = bytes([(FIRST_FRAME << 4) | (size >> 8), size & 0xFF])
+        else:
+            header = bytes([FIRST_FRAME << 4, 0]) + size.to_bytes(4, "big")
+        offset = 8 - len(header)
+        with self._condition:
+            self._flow_control = None
+        self._send_frame(header + view[:offset])
+        block_size, st_min = self._wait_flow_control()
+
+        sequence = 1
+        block_count = 0
+        while offset < size:
+            chunk = view[offset : offset + 7]
+            self._send_frame(bytes([(CONSECUTIVE_FRAME << 4) | sequence]) + chunk)
+            sequence = (sequence + 1) & 0xF
+            offset += len(chunk)
+            if offset >= size:
+                break
+
+            block_count += 1
+            if block_size and block_count == block_size:
+                block_count = 0
+                block_size, st_min = self._wait_flow_control()
+            elif st_min:
+                self._wait_separation_time(st_min)
+
+    def _wait_flow_control(self):
+        """ Wait for a continue to send flow control frame from the peer. """
+        with self._condition:
+            while True:
+                received = self._condition.wait_for(
+                    lambda: self._flow_control is not None, timeout=self.timeout
+                )
+                if not received:
+                    raise IsoTpError("Timeout waiting for flow control")
+                status, block_size, st_min = self._flow_control
+                self._flow_control = None
+                if status == CONTINUE_TO_SEND:
+                    return block_size, st_min
+                elif status == OVERFLOW:
+                    raise IsoTpError("PDU too large for the peer")
+                # On wait, keep on waiting for the next flow control.
+
+
+class IsoTpLayer:
+    """ Dispatch frames of a can link to ISO-TP sessions.
+
+    Sessions are looked up by their receive id, so each receive id can
+    be used by a single session only.
+    """
+
+    def __init__(self, can_link):
+        self.can_link = can_link
+        self._sessions = {}  # rx id -> session
+        self._tx_sessions = {}  # tx id -> session, for sending sessions
+        self._subscribers = []
+        can_link.attach_recv_callback(self._on_message)
+        can_link.attach_sent_callback(self._on_sent)
+
+    def add_session(self, rx_id, tx_id, **kwargs):
+        if rx_id in self._sessions:
+            raise ValueError("Receive id {:X} already in use".format(rx_id))
+        session = IsoTpSession(self, rx_id, tx_id, **kwargs)
+        if not session.listen_only:
+            if tx_id in self._tx_sessions:
+                raise ValueError("Transmit id {:X} already in use".format(tx_id))
+            self._tx_sessions[tx_id] = session
+        self._sessions[rx_id] = session
+        return session
+
+    def attach_pdu_callback(self, callback):
+        """ Register a callback, called for each reassembled PDU. """
+        self._subscribers.append(callback)
+
+    def check_timeouts(self):
+        for session in list(self._sessions.values()):
+            session.check_timeout()
+
+    def _on_message(self, message):
+        session = self._sessions.get(message.id)
+        if session is not None:
+            session.on_frame(message)
+
+    def _on_sent(self, message, latency):
+        session = self._tx_sessions.get(message.id)
+        if session is not None:
+            session.on_sent(message)
+
+    def _deliver(self, pdu):
+        if pdu.timestamp is None:
+            pdu.timestamp = datetime.datetime.now()
+        for callback in self._subscribers:
+            callback(pdu)
+
+
+def parse_session(text):
+    """ Parse a session in the form RX:TX, with can ids in hex. """
+    rx_id, tx_id = text.split(":")
+    return int(rx_id, 16), int(tx_id, 16)
@@ -0,0 +1,240 @@
+""" Lightweight runtime metrics.
+
+Metrics are disabled by default. Instrumented code checks
+``registry.enabled`` before measuring anything, so the overhead when
+disabled is a single attribute lookup.
+
+The metrics can be exported in the Prometheus text format, either on a
+local http port or into a file.
+"""
+
+import bisect
+import functools
+import http.server
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("can-explorer")
+
+# Buckets in seconds, from one microsecond up to one second:
+DEFAULT_BUCKETS = [
+    1e-6, 2.5e-6, 5e-6,
+    1e-5, 2.5e-5, 5e-5,
+    1e-4, 2.5e-4, 5e-4,
+    1e-3, 2.5e-3, 5e-3,
+    1e-2, 2.5e-2, 5e-2,
+    0.1, 0.25, 0.5,
+    1.0,
+]
+
+
+class Metric:
+    """ Base class of all metrics. """
+
+    kind = ""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+
+    def samples(self):
+        """ Give a list of (suffix, labels, value) tuples. """
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """ A monotonically increasing value. """
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [("", "", self.value)]
+
+
+class Gauge(Metric):
+    """ A value which can go up and down. """
+
+    kind = "gauge"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [("", "", self.value)]
+
+
+class Histogram(Metric):
+    """ Distribution of observed values over fixed buckets. """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self):
+        if self.count:
+            return self.sum / self.count
+        else:
+            return 0.0
+
+    def quantile(self, q):
+        """ Estimate a quantile, as the upper bound of its bucket. """
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append(("_bucket", '{{le="{}"}}'.format(bound), total))
+        samples.append(("_bucket", '{le="+Inf"}', self.count))
+        samples.append(("_sum", "", self.sum))
+        samples.append(("_count", "", self.count))
+        return samples
+
+
+class Registry:
+    """ A collection of metrics. """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def _get_or_create(self, cls, name, help):
+        if name not in self._metrics:
+            self._metrics[name] = cls(name, help)
+        metric = self._metrics[name]
+        if not isinstance(metric, cls):
+            raise ValueError("Metric {} is not a {}".format(name, cls.kind))
+        return metric
+
+    def counter(self, name, help):
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name, help):
+        return self._get_or_create(Histogram, name, help)
+
+    def to_prometheus(self):
+        """ Render all metrics in the Prometheus text format. """
+        lines = []
+        for metric in self:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append("{}{}{} {}".format(metric.name, suffix, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def timed(histogram):
+    """ Decorator which observes the duration of each call when enabled. """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return function(*args, **kwargs)
+            t1 = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - t1)
+
+        return wrapper
+
+    return decorator
+
+
+def serve_prometheus(port, registry=registry):
+    """ Serve the metrics on the given local port in a background thread. """
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    logger.info("Serving metrics on http://127.0.0.1:%s/metrics", port)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_prometheus(filename, interval=1.0, registry=registry):
+    """ Periodically write the metrics into the given file. """
+
+    def write_process():
+        while True:
+            temp_filename = filename + ".tmp"
+            with open(temp_filename, "w") as f:
+                f.write(registry.to_prometheus())
+            os.replace(temp_filename, filename)
+            time.sleep(interval)
+
+    logger.info("Writing metrics to %s", filename)
+    thread = threading.Thread(target=write_process, name="metrics-file")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def add_arguments(parser):
+    """ Add metrics options to an argument parser. """
+    parser.add_argument("--metrics", action="store_true", help="enable runtime metrics")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics on this port")
+    parser.add_argument("--metrics-file", help="write metrics to this file")
+
+
+def setup_from_args(args):
+    """ Enable and export metrics as given by the parsed arguments. """
+    if args.metrics or args.metrics_port or args.metrics_file:
+        registry.enabled = True
+    if args.metrics_port:
+        serve_prometheus(args.metrics_port)
+    if args.metrics_file:
+        write_prometheus(args.metrics_file)
@@ -0,0 +1,131 @@
+""" Tests for the decoding of error frames.
+
+Run with:
+
+    $ python -m unittest test_can_errors
+"""
+
+import socket
+import unittest
+
+import can_errors
+from can_errors import ErrorChannel, message_to_errors
+from can_link import CanMessage
+
+
+def error_message(classes, data=bytes(8)):
+    return CanMessage(socket.CAN_ERR_FLAG | classes, data)
+
+
+class MessageToErrorsTestCase(unittest.TestCase):
+    def test_not_an_error_frame(self):
+        with self.assertRaises(ValueError):
+            message_to_errors(CanMessage(0x123, bytes(8)))
+
+    def test_controller(self):
+        problems = (
+            can_errors.CAN_ERR_CRTL_TX_WARNING | can_errors.CAN_ERR_CRTL_RX_PASSIVE
+        )
+        data = bytes([0, problems]).ljust(8, b"\x00")
+        (error,) = message_to_errors(error_message(can_errors.CAN_ERR_CRTL, data))
+        self.assertIsInstance(error, can_errors.ControllerError)
+        self.assertEqual(("tx-warning", "rx-error-passive"), error.problems)
+        self.assertTrue(error.error_passive)
+        self.assertFalse(error.error_active)
+
+    def test_protocol_and_location(self):
+        data = bytes(
+            [0, 0, can_errors.CAN_ERR_PROT_FORM | can_errors.CAN_ERR_PROT_TX, 0x0A]
+        ).ljust(8, b"\x00")
+        (error,) = message_to_errors(error_message(can_errors.CAN_ERR_PROT, data))
+        self.assertIsInstance(error, can_errors.ProtocolError)
+        self.assertEqual(("form", "tx"), error.types)
+        self.assertEqual("data", error.location)
+        self.assertEqual("form, tx at data", str(error))
+
+    def test_unknown_location(self):
+        data = bytes([0, 0, 0, 0xFF]).ljust(8, b"\x00")
+        (error,) = message_to_errors(error_message(can_errors.CAN_ERR_PROT, data))
+        self.assertEqual("unknown", error.location)
+
+    def test_transceiver(self):
+        data = bytes([0, 0, 0, 0, 0x07]).ljust(8, b"\x00")
+        (error,) = message_to_errors(error_message(can_errors.CAN_ERR_TRX, data))
+        self.assertIsInstance(error, can_errors.TransceiverError)
+        self.assertEqual("canh-short-to-gnd", error.status)
+
+    def test_error_counters(self):
+        data = bytes([0, 0, 0, 0, 0, 0, 5, 9])
+        classes = (
+            can_errors.CAN_ERR_BUSOFF | can_errors.CAN_ERR_ACK | can_errors.CAN_ERR_CNT
+        )
+        errors = message_to_errors(error_message(classes, data))
+        self.assertEqual(
+            [can_errors.AckError, can_errors.BusOffError], [type(e) for e in errors]
+        )
+        for error in errors:
+            self.assertEqual(5, error.tx_errors)
+            self.assertEqual(9, error.rx_errors)
+
+    def test_without_counters(self):
+        data = bytes([0, 0, 0, 0, 0, 0, 5, 9])
+        (error,) = message_to_errors(error_message(can_errors.CAN_ERR_BUSOFF, data))
+        self.assertIsNone(error.tx_errors)
+        self.assertIsNone(error.rx_errors)
+
+    def test_short_frame(self):
+        classes = (
+            can_errors.CAN_ERR_LOSTARB
+            | can_errors.CAN_ERR_CRTL
+            | can_errors.CAN_ERR_PROT
+            | can_errors.CAN_ERR_TRX
+            | can_errors.CAN_ERR_CNT
+        )
+        errors = message_to_errors(error_message(classes, b"\x03"))
+        self.assertEqual(3, errors[0].bit)
+        self.assertEqual((), errors[1].problems)
+        self.assertEqual("unspecified", errors[2].location)
+        self.assertEqual("unspecified", errors[3].status)
+        self.assertEqual(0, errors[0].tx_errors)
+
+
+class ErrorChannelTestCase(unittest.TestCase):
+    def test_counts_and_get_all(self):
+        channel = ErrorChannel()
+        channel.put(error_message(can_errors.CAN_ERR_BUSOFF))
+        channel.put(error_message(can_errors.CAN_ERR_BUSOFF | can_errors.CAN_ERR_ACK))
+        self.assertEqual(2, channel.counts["bus-off"])
+        self.assertEqual(1, channel.counts["no-ack"])
+
+        pending = channel.get_all()
+        self.assertEqual(2, len(pending))
+        message, errors = pending[1]
+        self.assertEqual(2, len(errors))
+        self.assertEqual([], channel.get_all())
+
+    def test_drops_oldest(self):
+        channel = ErrorChannel(maxsize=2)
+        for classes in (
+            can_errors.CAN_ERR_TX_TIMEOUT,
+            can_errors.CAN_ERR_ACK,
+            can_errors.CAN_ERR_BUSOFF,
+        ):
+            channel.put(error_message(classes))
+        self.assertEqual(1, channel.dropped)
+        self.assertEqual(1, channel.counts["tx-timeout"])
+        errors = [errors[0] for _, errors in channel.get_all()]
+        self.assertEqual(
+            [can_errors.AckError, can_errors.BusOffError], [type(e) for e in errors]
+        )
+
+    def test_callback(self):
+        channel = ErrorChannel()
+        received = []
+        channel.attach_callback(received.append)
+        message = error_message(can_errors.CAN_ERR_RESTARTED)
+        channel.put(message)
+        self.assertEqual([message], received)
+
+
+if __name__ == "__main__":
+    unittest.main()
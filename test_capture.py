@@ -0,0 +1,131 @@
+""" Tests for the triggered capture.
+
+Run with:
+
+    $ python -m unittest test_capture
+"""
+
+import datetime
+import glob
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+import can_errors
+from can_link import CanMessage, DummyCanLink
+from capture import PayloadMatcher, TriggerCapture, parse_trigger
+
+
+class PayloadMatcherTestCase(unittest.TestCase):
+    def test_value_is_masked(self):
+        matcher = PayloadMatcher(bytes.fromhex("12ff"), bytes.fromhex("ff0f"))
+        self.assertTrue(matcher(bytes.fromhex("120f")))
+        self.assertTrue(matcher(bytes.fromhex("12ff")))
+        self.assertFalse(matcher(bytes.fromhex("130f")))
+
+    def test_short_payload(self):
+        matcher = PayloadMatcher(bytes.fromhex("1234"))
+        self.assertFalse(matcher(bytes.fromhex("12")))
+
+    def test_parse_trigger(self):
+        can_id, matcher = parse_trigger("7e8:10ff/f00f")
+        self.assertEqual(0x7E8, can_id)
+        self.assertTrue(matcher(bytes.fromhex("1a0f")))
+        self.assertEqual((0x100, None), parse_trigger("100"))
+
+
+class TriggerCaptureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.can_link = DummyCanLink()
+        self.capture = TriggerCapture(
+            directory=self.directory.name, post_frames=2, post_seconds=None
+        )
+        self.capture.attach(self.can_link)
+
+    def tearDown(self):
+        self.capture.close()
+        self.directory.cleanup()
+
+    def read_captures(self):
+        self.capture.close()
+        captures = []
+        pattern = os.path.join(self.directory.name, "capture-*.log")
+        for filename in sorted(glob.glob(pattern)):
+            with open(filename) as f:
+                captures.append(f.read().splitlines())
+        return captures
+
+    def send(self, can_id, data=b"\x00", timestamp=None):
+        self.can_link._recv(CanMessage(can_id, data, timestamp=timestamp))
+
+    def test_id_trigger(self):
+        self.capture.add_id_trigger(0x123)
+        self.send(0x100)
+        self.send(0x123)
+        self.send(0x101)
+        self.send(0x102)
+        self.send(0x103)
+        captures = self.read_captures()
+        self.assertEqual(1, len(captures))
+        header, *frames = captures[0]
+        self.assertIn("id 123", header)
+        ids = [line.split()[2] for line in frames]
+        self.assertEqual(["ID=100", "ID=123", "ID=101", "ID=102"], ids)
+
+    def test_payload_trigger(self):
+        self.capture.add_id_trigger(0x123, PayloadMatcher(b"\x10", b"\xf0"))
+        self.send(0x123, b"\x20")
+        self.send(0x123, b"\x1f")
+        captures = self.read_captures()
+        self.assertEqual(1, len(captures))
+        self.assertIn("payload of 123", captures[0][0])
+        self.assertIn("DATA=1F", captures[0][0])
+
+    def test_error_trigger(self):
+        self.capture.trigger_on_error = True
+        self.send(0x100)
+        error = CanMessage(socket.CAN_ERR_FLAG | can_errors.CAN_ERR_BUSOFF, bytes(8))
+        self.can_link.errors.put(error)
+        self.send(0x101)
+        captures = self.read_captures()
+        self.assertEqual(1, len(captures))
+        self.assertIn("error frame", captures[0][0])
+        self.assertEqual(3, len(captures[0]) - 1)
+
+    def test_rate_trigger(self):
+        self.capture.max_rate = 3
+        second = datetime.datetime(2020, 1, 1, 12, 0, 0)
+        for i in range(3):
+            self.send(0x100, timestamp=second + datetime.timedelta(milliseconds=i))
+        self.assertEqual([], self.read_captures())
+
+    def test_rate_trigger_fires(self):
+        self.capture.max_rate = 3
+        second = datetime.datetime(2020, 1, 1, 12, 0, 0)
+        for i in range(4):
+            self.send(0x100, timestamp=second + datetime.timedelta(milliseconds=i))
+        captures = self.read_captures()
+        self.assertEqual(1, len(captures))
+        self.assertIn("rate above 3/s", captures[0][0])
+
+    def test_pre_frames_must_include_trigger(self):
+        with self.assertRaises(ValueError):
+            TriggerCapture(directory=self.directory.name, pre_frames=0)
+
+    def test_post_seconds_expire_without_frames(self):
+        self.capture.post_frames = 1000
+        self.capture.post_seconds = 0.05
+        self.capture.add_id_trigger(0x123)
+        self.send(0x123)
+        pattern = os.path.join(self.directory.name, "capture-*.log")
+        deadline = time.monotonic() + 5.0
+        while not glob.glob(pattern) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(1, len(glob.glob(pattern)))
+
+
+if __name__ == "__main__":
+    unittest.main()
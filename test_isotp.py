@@ -0,0 +1,105 @@
+""" Tests for the ISO-TP transport layer.
+
+Run with:
+
+    $ python -m unittest test_isotp
+"""
+
+import time
+import unittest
+
+import isotp
+from can_link import CanMessage, DummyCanLink
+
+
+class IsoTpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.can_link = DummyCanLink()
+        self.layer = isotp.IsoTpLayer(self.can_link)
+        self.pdus = []
+        self.layer.attach_pdu_callback(self.pdus.append)
+        self.session = self.layer.add_session(
+            0x7E8, 0x7E0, listen_only=True, timeout=0.05
+        )
+
+    def send(self, data, can_id=0x7E8):
+        self.can_link._recv(CanMessage(can_id, bytes.fromhex(data)))
+
+    def test_single_frame(self):
+        self.send("03 01 02 03")
+        self.assertEqual([b"\x01\x02\x03"], [pdu.data for pdu in self.pdus])
+
+    def test_reassembly(self):
+        self.send("10 0A 00 01 02 03 04 05")
+        self.send("21 06 07 08 09")
+        self.assertEqual([bytes(range(10))], [pdu.data for pdu in self.pdus])
+        self.assertEqual(1, self.session.completed)
+
+    def test_other_ids_are_ignored(self):
+        self.send("03 01 02 03", can_id=0x123)
+        self.assertEqual([], self.pdus)
+
+    def test_wrong_sequence_number(self):
+        self.send("10 0A 00 01 02 03 04 05")
+        with self.assertLogs("can-explorer", "WARNING"):
+            self.send("22 06 07 08 09")
+        self.assertEqual([], self.pdus)
+        self.assertEqual(1, self.session.aborted)
+
+    def test_timeout(self):
+        self.send("10 0A 00 01 02 03 04 05")
+        time.sleep(0.1)
+        with self.assertLogs("can-explorer", "WARNING"):
+            self.layer.check_timeouts()
+        self.send("21 06 07 08 09")
+        self.assertEqual([], self.pdus)
+        self.assertEqual(1, self.session.aborted)
+
+    def test_short_first_frame(self):
+        with self.assertLogs("can-explorer", "WARNING"):
+            self.send("10")
+            self.send("10 00 01 02")
+        self.assertEqual(2, self.session.aborted)
+
+    def test_first_frame_smaller_than_its_data(self):
+        with self.assertLogs("can-explorer", "WARNING"):
+            self.send("10 03 01 02 03 04 05 06")
+        self.send("21 07 08")
+        self.assertEqual([], self.pdus)
+        self.assertEqual(1, self.session.aborted)
+
+    def test_single_frame_larger_than_its_data(self):
+        with self.assertLogs("can-explorer", "WARNING"):
+            self.send("07 01 02")
+            self.send("00")
+        self.assertEqual([], self.pdus)
+        self.assertEqual(2, self.session.aborted)
+
+    def test_reception_continues_after_malformed_frames(self):
+        with self.assertLogs("can-explorer", "WARNING"):
+            self.send("10")
+        self.send("03 01 02 03")
+        self.assertEqual([b"\x01\x02\x03"], [pdu.data for pdu in self.pdus])
+
+
+class IsoTpTransferTestCase(unittest.TestCase):
+    def test_send_and_receive(self):
+        can_link = DummyCanLink()
+        layer = isotp.IsoTpLayer(can_link)
+        pdus = []
+        layer.attach_pdu_callback(pdus.append)
+        sender = layer.add_session(0x7E8, 0x7E0)
+        layer.add_session(0x7E0, 0x7E8, block_size=4)
+        payload = bytes(i & 0xFF for i in range(300))
+        sender.send(payload)
+        self.assertEqual([payload], [pdu.data for pdu in pdus])
+
+    def test_transmit_id_in_use(self):
+        layer = isotp.IsoTpLayer(DummyCanLink())
+        layer.add_session(0x7E8, 0x7E0)
+        with self.assertRaises(ValueError):
+            layer.add_session(0x7E9, 0x7E0)
+
+
+if __name__ == "__main__":
+    unittest.main()